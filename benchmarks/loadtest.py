@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Load test of the upload views of the testing project. For every scenario a
+local threaded WSGI server is started in a new process, and a pool of client
+threads sends it a mix of valid, oversize and wrong type multipart uploads.
+Throughput, latency percentiles and the peak RSS of the server are reported.
+Everything runs on the loopback interface.
+
+Every response is compared with the status expected for its upload, and the
+run fails if any differs or is a server error, so timings of broken views
+are not mistaken for results.
+
+    python benchmarks/loadtest.py [--requests 500] [--concurrency 1,4,16] [--output results.json]
+
+Each scenario is run at every concurrency given, to see where it stops
+scaling.
+"""
+from optparse import OptionParser
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import httplib
+except ImportError:  # Python 3
+    import http.client as httplib
+
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:  # Python 3
+    from socketserver import ThreadingMixIn
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testing.settings')
+
+SAMPLE_FILES_PATH = os.path.join(ROOT, 'testing', 'sample_files')
+
+# Valid, oversize and wrong type uploads for TestModel (png, up to 10 KB)
+UPLOADS = [
+    ('image2k.png', 'image/png'),
+    ('image2k.png', 'image/png'),
+    ('image15k.png', 'image/png'),
+    ('document1k.pdf', 'application/pdf'),
+]
+
+# The status expected for each of the uploads. TestElement has no size
+# limit, and the quota of the container is raised to hold every upload of
+# the run, so only the wrong type is rejected there.
+SCENARIOS = [
+    ('no_validate', '/upload/no-validate/', (201, 201, 201, 201)),
+    ('validated', '/upload/', (201, 201, 400, 400)),
+    ('quota', '/upload/element/%(container)s/', (201, 201, 201, 400)),
+]
+
+
+def serve(max_usage):
+    """
+    Runs the testing project on a free port of the loopback interface, with
+    a database and media root of its own, until a line is read from stdin.
+    Writes the port and the id of a container, and on exit the peak RSS.
+    The quota of the containers is raised to max_usage bytes.
+    """
+    from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+    from django.conf import settings
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.core.management import call_command
+
+    work_dir = tempfile.mkdtemp()
+    settings.MEDIA_ROOT = os.path.join(work_dir, 'media')
+    # Each server thread opens its own connection, so the database is a file
+    settings.DATABASES['default']['NAME'] = os.path.join(work_dir, 'loadtest.sqlite3')
+    call_command('syncdb', interactive=False, verbosity=0)
+
+    from testing.forms import TestElementForm
+    from testing.models import TestContainer
+    container = TestContainer.objects.create(name='loadtest')
+    # Otherwise the container is full after a few uploads, and the rest of
+    # the run measures rejections
+    TestElementForm.base_fields['the_file'].validators[0].quota.max_usage = max_usage
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietRequestHandler(WSGIRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, WSGIHandler(), ThreadingWSGIServer, QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    sys.stdout.write('%d %d\n' % (server.server_address[1], container.pk))
+    sys.stdout.flush()
+
+    sys.stdin.readline()
+    server.shutdown()
+    sys.stdout.write('%d\n' % peak_rss())
+    sys.stdout.flush()
+    shutil.rmtree(work_dir)
+
+
+def peak_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on Mac OS X
+    return sys.platform == 'darwin' and peak or peak * 1024
+
+
+def multipart_body(filename, content_type, content):
+    boundary = '----validatedfile-loadtest'
+    body = b''.join([
+        ('--%s\r\n' % boundary).encode('ascii'),
+        ('Content-Disposition: form-data; name="the_file"; filename="%s"\r\n' % filename).encode('ascii'),
+        ('Content-Type: %s\r\n\r\n' % content_type).encode('ascii'),
+        content,
+        ('\r\n--%s--\r\n' % boundary).encode('ascii'),
+    ])
+    return 'multipart/form-data; boundary=%s' % boundary, body
+
+
+def load_uploads():
+    uploads = []
+    for filename, content_type in UPLOADS:
+        with open(os.path.join(SAMPLE_FILES_PATH, filename), 'rb') as sample:
+            uploads.append(multipart_body(filename, content_type, sample.read()))
+    return uploads
+
+
+def send(port, path, uploads, expected, count, latencies, statuses, unexpected, lock):
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    try:
+        for i in range(count):
+            content_type, body = uploads[i % len(uploads)]
+            start = time.time()
+            connection.request('POST', path, body, {'Content-Type': content_type})
+            response = connection.getresponse()
+            response.read()
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+                if response.status != expected[i % len(uploads)]:
+                    key = '%s %d' % (UPLOADS[i % len(uploads)][0], response.status)
+                    unexpected[key] = unexpected.get(key, 0) + 1
+    finally:
+        connection.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_scenario(name, path, expected, requests, concurrency):
+    uploads = load_uploads()
+    max_usage = requests * max([len(body) for content_type, body in uploads])
+    server = subprocess.Popen([sys.executable, os.path.realpath(__file__), '--serve',
+                               '--max-usage', str(max_usage)],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        port, container = [int(part) for part in server.stdout.readline().split()]
+        path = path % {'container': container}
+        latencies = []
+        statuses = {}
+        unexpected = {}
+        lock = threading.Lock()
+        counts = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+        clients = [threading.Thread(target=send, args=(port, path, uploads, expected, count, latencies,
+                                                       statuses, unexpected, lock))
+                   for count in counts]
+
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        seconds = time.time() - start
+
+        server.stdin.write(b'\n')
+        server.stdin.flush()
+        rss = int(server.stdout.readline())
+    finally:
+        server.wait()
+
+    return {
+        'scenario': name,
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'requests_per_second': seconds and len(latencies) / seconds or None,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p90': percentile(latencies, 0.9) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies) * 1000,
+        },
+        'statuses': dict([(str(status), count) for status, count in statuses.items()]),
+        'unexpected_statuses': unexpected,
+        'server_errors': sum([count for status, count in statuses.items() if status >= 500]),
+        'server_peak_rss_bytes': rss,
+    }
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--requests', type='int', default=500,
+                      help="uploads sent in each scenario")
+    parser.add_option('--concurrency', default='1,4,16',
+                      help="comma separated numbers of client threads sending uploads at the same time")
+    parser.add_option('--output', default='loadtest_results.json',
+                      help="file where the JSON results are written")
+    parser.add_option('--serve', action='store_true', default=False,
+                      help="run the server of one scenario (used internally)")
+    parser.add_option('--max-usage', type='int', default=10000,
+                      help="quota of the containers of the server (used internally)")
+    options, args = parser.parse_args()
+
+    if options.serve:
+        return serve(options.max_usage)
+
+    results = [run_scenario(name, path, expected, options.requests, int(concurrency))
+               for name, path, expected in SCENARIOS for concurrency in options.concurrency.split(',')]
+    report = {
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    for row in results:
+        latency = row['latency_ms']
+        sys.stdout.write('%-12s x%-3d %8.1f req/s  p50 %7.1f ms  p90 %7.1f ms  p99 %7.1f ms  rss %6.1f MB  %s\n' % (
+            row['scenario'], row['concurrency'], row['requests_per_second'] or 0, latency['p50'], latency['p90'],
+            latency['p99'], row['server_peak_rss_bytes'] / 1048576.0, json.dumps(row['statuses'], sort_keys=True)))
+
+    failed = [row for row in results if row['unexpected_statuses'] or row['server_errors']]
+    for row in failed:
+        sys.stderr.write('%s x%d: unexpected responses %s\n' % (
+            row['scenario'], row['concurrency'], json.dumps(row['unexpected_statuses'], sort_keys=True)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
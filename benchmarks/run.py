@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the validation and quota hot paths, run offline on the
+testing project and its sample files.
+
+    python benchmarks/run.py [--output results.json] [--max-items 100000]
+
+The results are written as JSON, so runs of different releases can be
+compared with each other.
+"""
+from optparse import OptionParser
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testing.settings')
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.db import connection
+
+import validatedfile
+from validatedfile.fields import FileQuota, QuotaValidator
+from validatedfile.metrics import RecordingCollector, set_collector
+from validatedfile.models import FileUsage
+from validatedfile.sniffing import peek
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from benchmarks import sniff_length
+
+SAMPLE_FILES_PATH = os.path.join(ROOT, 'testing', 'sample_files')
+ITEM_COUNTS = [10, 100, 1000, 10000, 100000]
+
+
+def timed(repeat, function, *args):
+    start = time.time()
+    for i in range(repeat):
+        function(*args)
+    return time.time() - start
+
+
+def result(benchmark, params, repeat, seconds):
+    return {
+        'benchmark': benchmark,
+        'params': params,
+        'repeat': repeat,
+        'seconds': seconds,
+        'per_op_us': seconds / repeat * 1000000,
+        'ops_per_second': seconds and repeat / seconds or None,
+    }
+
+
+def bench_clean(repeat):
+    from testing.models import TestModel, TestModelNoValidate
+
+    results = []
+    for filename, content in sniff_length.sample_files():
+        for model in (TestModel, TestModelNoValidate):
+            field = model._meta.get_field('the_file')
+
+            def clean():
+                instance = model(the_file=SimpleUploadedFile(name=filename, content=content))
+                try:
+                    field.clean(instance.the_file, instance)
+                except ValidationError:
+                    pass  # Rejected files are timed as well
+
+            clean()  # Warm up the detector
+            results.append(result('clean', {
+                'file': filename,
+                'size': len(content),
+                'content_types': field.content_types,
+            }, repeat, timed(repeat, clean)))
+    return results
+
+
+def bench_sniff_length(repeat):
+    return [result('sniff', {
+                'file': row['file'],
+                'mode': row['mode'],
+                'bytes_read': row['bytes_read'],
+            }, 1, row['microseconds'] / 1000000.0)
+            for row in sniff_length.run(repeat)]
+
+
+def read_and_seek(file, length):
+    buffer = file.read(length)
+    file.seek(0)
+    return buffer
+
+
+def peak_allocation(function, *args):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_peek(repeat):
+    results = []
+    for filename, content in sniff_length.sample_files():
+        temporary_file = TemporaryUploadedFile(filename, None, len(content), None)
+        temporary_file.write(content)
+        temporary_file.seek(0)
+        files = [('memory', SimpleUploadedFile(name=filename, content=content)),
+                 ('temporary', temporary_file)]
+        for storage, file in files:
+            for mode, function in (('read_seek', read_and_seek), ('peek', peek)):
+                results.append(result('sniff_read', {
+                    'file': filename,
+                    'upload': storage,
+                    'mode': mode,
+                    'peak_allocated_bytes': peak_allocation(function, file, 4096),
+                }, repeat, timed(repeat, function, file, 4096)))
+        temporary_file.close()
+    return results
+
+
+def bench_quota(max_items, repeat):
+    from testing.models import TestContainer, TestElement
+
+    field = TestElement._meta.get_field('the_file')
+    with open(os.path.join(SAMPLE_FILES_PATH, 'image2k.png'), 'rb') as sample:
+        name = field.storage.save('benchmark/image2k.png', File(sample))
+    size = field.storage.size(name)
+
+    container = TestContainer.objects.create(name='benchmark')
+    results = []
+    count = 0
+    for item_count in [n for n in ITEM_COUNTS if n <= max_items]:
+        # Small batches keep below the SQLite limit of query parameters
+        for start in range(count, item_count, 100):
+            TestElement.objects.bulk_create([
+                TestElement(container=container, the_file=name, the_file_size=size)
+                for i in range(start, min(start + 100, item_count))
+            ])
+        FileUsage.objects.add_usage(TestContainer, container.pk, size * (item_count - count))
+        count = item_count
+
+        items = container.test_elements.all()
+        quota = FileQuota(max_usage=size * count)
+        quota_repeat = max(1, repeat // count)
+        params = {'items': count}
+
+        collector = RecordingCollector()
+        set_collector(collector)
+        quota.update(items, 'the_file')
+        set_collector(None)
+        params['storage_size_calls'] = collector.counters.get('storage_size_calls', 0)
+        results.append(result('quota_update', params, quota_repeat,
+                              timed(quota_repeat, quota.update, items, 'the_file')))
+        results.append(result('quota_update_from_queryset', params, repeat,
+                              timed(repeat, quota.update_from_queryset, items, 'the_file')))
+        results.append(result('quota_update_from_usage', params, repeat,
+                              timed(repeat, quota.update_from_usage, container)))
+
+        validator = QuotaValidator(max_usage=size * count)
+        validator.update_quota_from_queryset(items, 'the_file')
+        upload = SimpleUploadedFile(name='image2k.png', content=b'\0' * size)
+
+        def validate():
+            try:
+                validator(upload)
+            except ValidationError:
+                pass
+
+        results.append(result('quota_validator', params, repeat, timed(repeat, validate)))
+
+        def reserve():
+            reservation = FileUsage.objects.reserve(TestContainer, container.pk, size, size * (count + 1))
+            FileUsage.objects.release_reservation(reservation)
+
+        # Reserving costs the same whatever the number of items
+        results.append(result('quota_reserve_release', params, repeat, timed(repeat, reserve)))
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--output', default='benchmark_results.json',
+                      help="file where the JSON results are written")
+    parser.add_option('--repeat', type='int', default=1000,
+                      help="iterations of each benchmark")
+    parser.add_option('--max-items', type='int', default=ITEM_COUNTS[-1],
+                      help="largest number of related items in the quota benchmarks")
+    options, args = parser.parse_args()
+
+    settings.MEDIA_ROOT = tempfile.mkdtemp()
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        results = bench_clean(options.repeat)
+        results += bench_sniff_length(options.repeat)
+        results += bench_peek(options.repeat)
+        results += bench_quota(options.max_items, options.repeat)
+    finally:
+        shutil.rmtree(settings.MEDIA_ROOT)
+
+    report = {
+        'version': '.'.join([str(part) for part in validatedfile.__version__]),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    for row in results:
+        sys.stdout.write('%-28s %-60s %12.1f us/op\n' % (
+            row['benchmark'], json.dumps(row['params'], sort_keys=True), row['per_op_us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compares the bytes read and the time spent sniffing the sample files with
+the adaptive sniff length against the fixed mime_lookup_length read.
+
+    python benchmarks/sniff_length.py [repeat]
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testing.settings')
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from validatedfile.fields import ValidatedFileField
+
+SAMPLE_FILES_PATH = os.path.join(ROOT, 'testing', 'sample_files')
+
+
+class CountingFile(object):
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset):
+        self.file.seek(offset)
+
+    def tell(self):
+        return self.file.tell()
+
+
+def sample_files():
+    for filename in sorted(os.listdir(SAMPLE_FILES_PATH)):
+        with open(os.path.join(SAMPLE_FILES_PATH, filename), 'rb') as sample:
+            yield filename, sample.read()
+
+
+def measure(field, content, repeat):
+    file = CountingFile(SimpleUploadedFile(name='sample', content=content))
+    field.sniff_content_type(file)  # Warm up the detector
+    file.bytes_read = 0
+    start = time.time()
+    for i in range(repeat):
+        field.sniff_content_type(file)
+    elapsed = time.time() - start
+    return file.bytes_read // repeat, elapsed / repeat * 1000000
+
+
+def run(repeat=1000):
+    results = []
+    for filename, content in sample_files():
+        for mode in ('adaptive', 'fixed'):
+            field = ValidatedFileField(content_types=['image/png', 'image/jpeg'])
+            if mode == 'fixed':
+                field.sniff_length = field.mime_lookup_length
+            bytes_read, microseconds = measure(field, content, repeat)
+            results.append({
+                'file': filename,
+                'mode': mode,
+                'bytes_read': bytes_read,
+                'microseconds': microseconds,
+            })
+    return results
+
+
+if __name__ == '__main__':
+    repeat = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    sys.stdout.write('%-20s %-10s %10s %12s\n' % ('file', 'mode', 'bytes read', 'usec/sniff'))
+    for result in run(repeat):
+        sys.stdout.write('%(file)-20s %(mode)-10s %(bytes_read)10d %(microseconds)12.1f\n' % result)
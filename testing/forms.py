@@ -39,3 +39,11 @@ class TestElementForm(forms.ModelForm):
         element = super(TestElementForm, self).save(commit=False)
         element.container = self.container
         element.save()
+
+
+class TestElementReservingForm(TestElementForm):
+
+    def __init__(self, container, *args, **kwargs):
+        super(TestElementReservingForm, self).__init__(container, *args, **kwargs)
+        validators = self.fields['the_file'].validators
+        validators[0] = validators[0].reserve_for(container)
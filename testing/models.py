@@ -1,5 +1,13 @@
 from django.db import models
+from validatedfile.deferred import STATUS_CHOICES
 from validatedfile.fields import ValidatedFileField
+from validatedfile.stages import PdfStructureStage
+from validatedfile.storage import DeduplicatingFileSystemStorage
+
+from testing.storage import CountingStorage
+
+deduplicating_storage = DeduplicatingFileSystemStorage()
+counting_storage = CountingStorage()
 
 class TestModel(models.Model):
     the_file = ValidatedFileField(
@@ -9,6 +17,15 @@ class TestModel(models.Model):
                     content_types = ['image/png'],
                     max_upload_size = 10240)
 
+class TestRemoteModel(models.Model):
+    the_file = ValidatedFileField(
+                    null = True,
+                    blank = True,
+                    upload_to = 'testfile',
+                    storage = counting_storage,
+                    content_types = ['image/png'],
+                    max_upload_size = 10240)
+
 class TestModelNoValidate(models.Model):
     the_file = ValidatedFileField(
                     null = True,
@@ -28,5 +45,43 @@ class TestElement(models.Model):
                     null = True,
                     blank = True,
                     upload_to = 'testfile',
-                    content_types = ['image/png', 'image/jpeg'])
+                    content_types = ['image/png', 'image/jpeg'],
+                    quota_owner = 'container',
+                    size_field = 'the_file_size')
+    the_file_size = models.BigIntegerField(
+                    null = True,
+                    blank = True)
+
+
 
+class TestDocument(models.Model):
+    the_file = ValidatedFileField(
+                    null = True,
+                    blank = True,
+                    upload_to = 'documents',
+                    storage = deduplicating_storage,
+                    content_types = ['application/pdf'],
+                    size_field = 'the_file_size',
+                    digest_field = 'the_file_digest')
+    the_file_size = models.BigIntegerField(
+                    null = True,
+                    blank = True)
+    the_file_digest = models.CharField(
+                    max_length = 64,
+                    null = True,
+                    blank = True)
+
+
+class TestDeferredModel(models.Model):
+    the_file = ValidatedFileField(
+                    null = True,
+                    blank = True,
+                    upload_to = 'testfile',
+                    content_types = ['application/pdf'],
+                    deep_stages = [PdfStructureStage()],
+                    status_field = 'the_file_status')
+    the_file_status = models.CharField(
+                    max_length = 20,
+                    choices = STATUS_CHOICES,
+                    null = True,
+                    blank = True)
@@ -0,0 +1,68 @@
+import struct
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+
+class ScannerHandler(socketserver.BaseRequestHandler):
+    # Stand-in for clamd: answers INSTREAM scans, reporting as infected any
+    # stream that contains the marker.
+
+    def handle(self):
+        command = self.read_until(b'\0')
+        if command != b'zINSTREAM\0':
+            self.request.sendall(b'UNKNOWN COMMAND\0')
+            return
+
+        data = b''
+        try:
+            while True:
+                length = struct.unpack('!L', self.read_exactly(4))[0]
+                if not length:
+                    break
+                data += self.read_exactly(length)
+        except IOError:
+            return  # The client gave up before the end of the stream
+        self.server.scanned.append(len(data))
+
+        if self.server.marker in data:
+            self.request.sendall(b'stream: Test-Signature FOUND\0')
+        else:
+            self.request.sendall(b'stream: OK\0')
+
+    def read_until(self, terminator):
+        data = b''
+        while not data.endswith(terminator):
+            data += self.read_exactly(1)
+        return data
+
+    def read_exactly(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise IOError("Connection closed")
+            data += chunk
+        return data
+
+
+class FakeScanner(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, marker=b'INFECTED'):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), ScannerHandler)
+        self.marker = marker
+        self.scanned = []
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,32 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+
+class CountingStorage(FileSystemStorage):
+    """
+    Local stand-in for a remote object storage that counts the bytes
+    transferred. Opening a file downloads all of it, as object storages
+    without streaming do; read_range only transfers the bytes asked for.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.bytes_transferred = 0
+
+    def _open(self, name, mode='rb'):
+        file = super(CountingStorage, self)._open(name, mode)
+        try:
+            content = file.read()
+        finally:
+            file.close()
+        self.bytes_transferred += len(content)
+        file = ContentFile(content)
+        file.name = name
+        return file
+
+    def read_range(self, name, start, length):
+        with open(self.path(name), 'rb') as file:
+            file.seek(start)
+            data = file.read(length)
+        self.bytes_transferred += len(data)
+        return data
@@ -1,14 +1,55 @@
 from django.test import TestCase
+from django.core.exceptions import ValidationError
 from django.core.files import File
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.core.management import call_command
+from django.db import connections
 from django.conf import settings
+from django.test.utils import override_settings
 
+import hashlib
+import io
 import os.path
+import json
+import multiprocessing
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+from validatedfile.cache import LRUCache, SQLiteCache, get_detection_cache, get_usage_cache, \
+                                reset_detection_cache, reset_usage_cache, usage_key
+from validatedfile import deferred
+from validatedfile.deferred import ACCEPTED, QUARANTINED, finish_deep_validation, reset_runner
+from validatedfile.detectors import reset_detector
+from validatedfile.fields import FileQuota, QuotaValidator, ValidatedFileField, detector_pool
+from validatedfile.handlers import RejectedUpload, ValidatedFileUploadHandler
+from validatedfile.metrics import RecordingCollector, set_collector
+from validatedfile.models import FileUsage, QuotaReservation
+from validatedfile.policies import ContentTypePolicy
+from validatedfile.signals import file_validated
+from validatedfile.signatures import match_signature
+from validatedfile.images import INCOMPLETE, image_dimensions
+from validatedfile.sniffing import peek, reusable_buffer
+from validatedfile.stages import SocketScannerStage, ValidationStage
+from validatedfile.storage import StoredFile
+from validatedfile.workers import background_pool
+
+from testing.models import TestModel, TestModelNoValidate, TestContainer, TestElement, TestDocument, \
+                           TestDeferredModel, TestRemoteModel, counting_storage
+from testing.forms import TestModelForm, TestModelNoValidateForm, TestElementForm, TestElementReservingForm
+from testing.scanner import FakeScanner
+
+def _sniff_in_worker(content, results):
+    field = TestModel._meta.get_field('the_file')
+    field.sniff_content_type(SimpleUploadedFile(name = 'the_file.doc', content = content))
+    cache = get_detection_cache()
+    results.put((cache.hits, cache.misses))
 
-from validatedfile.fields import FileQuota
-
-from testing.models import TestModel, TestModelNoValidate, TestContainer, TestElement
-from testing.forms import TestModelForm, TestModelNoValidateForm, TestElementForm
 
 class ValidatedFileFieldTest(TestCase):
 
@@ -76,6 +117,17 @@ class ValidatedFileFieldTest(TestCase):
         self.assertEqual(form.errors['the_file'][0], u'Files of type application/pdf are not supported.')
 
 
+    def test_invalid_filetype_and_size_streaming(self):
+        # The digest makes the whole file be read, the type still comes first
+        field = ValidatedFileField(content_types = ['image/png'], max_upload_size = 10240,
+                                   digest_field = 'the_file_digest')
+        try:
+            field.validate_file(self._create_uploaded_file('document15k.pdf'))
+            self.fail('The pdf file was accepted')
+        except ValidationError as e:
+            self.assertEqual(e.messages, [u'Files of type application/pdf are not supported.'])
+
+
     def test_form_fake_filetype(self):
         form = self._create_bound_test_model_form(form_class = TestModelForm,
                                                   orig_filename = 'document1k.pdf',
@@ -111,6 +163,845 @@ class ValidatedFileFieldTest(TestCase):
         instance.delete()
 
 
+    def test_form_reuses_detector(self):
+        created = []
+        original_factory = detector_pool.factory
+
+        def counting_factory():
+            created.append(1)
+            return original_factory()
+
+        detector_pool.factory = counting_factory
+        detector_pool.reset()
+        try:
+            # Signatures do not tell OLE documents apart, so libmagic is used
+            for i in range(3):
+                form = self._create_bound_test_model_form(form_class = TestModelForm,
+                                                          orig_filename = 'document15k.doc',
+                                                          dest_filename = 'the_file.doc',
+                                                          content_type = 'application/msword')
+                self.assertFalse(form.is_valid())
+            self.assertEqual(len(created), 1)
+        finally:
+            detector_pool.factory = original_factory
+            detector_pool.reset()
+
+
+    def test_signatures_match_libmagic(self):
+        for filename in os.listdir(self.SAMPLE_FILES_PATH):
+            buffer = self._get_sample_file(filename).read(4096)
+            content_type = match_signature(buffer)
+            if content_type is not None:
+                self.assertEqual(content_type, detector_pool.get().from_buffer(buffer))
+        self.assertEqual(match_signature(self._get_sample_file('image2k.png').read(16)), 'image/png')
+        self.assertEqual(match_signature(self._get_sample_file('document1k.pdf').read(16)), 'application/pdf')
+        self.assertEqual(match_signature(self._get_sample_file('document15k.doc').read(16)), None)
+
+
+    @override_settings(VALIDATEDFILE_DETECTOR = 'signatures')
+    def test_signatures_detector(self):
+        reset_detector()
+        try:
+            field = TestModel._meta.get_field('the_file')
+            for filename, content_type in (('image2k.png', 'image/png'),
+                                           ('document1k.pdf', 'application/pdf'),
+                                           ('document15k.doc', 'application/octet-stream')):
+                uploaded_file = self._create_uploaded_file(filename)
+                self.assertEqual(field.sniff_content_type(uploaded_file), content_type)
+        finally:
+            reset_detector()
+
+
+    @override_settings(VALIDATEDFILE_DETECTOR = lambda buffer: 'application/msword')
+    def test_custom_detector(self):
+        reset_detector()
+        try:
+            field = TestModelNoValidate._meta.get_field('the_file')
+            uploaded_file = self._create_uploaded_file('document15k.doc')
+            self.assertEqual(field.sniff_content_type(uploaded_file), 'application/msword')
+        finally:
+            reset_detector()
+
+
+    def test_import_time(self):
+        # Measured in a new process, where nothing else has been imported yet
+        script = '\n'.join([
+            'import sys, time',
+            'import django.db.models',
+            'start = time.time()',
+            'import validatedfile.fields',
+            'sys.stdout.write("%f %s %s" % (time.time() - start, "magic" in sys.modules, "south" in sys.modules))',
+        ])
+        environ = dict(os.environ, DJANGO_SETTINGS_MODULE = 'testing.settings')
+        process = subprocess.Popen([sys.executable, '-c', script], stdout = subprocess.PIPE, env = environ)
+        seconds, magic_loaded, south_loaded = process.communicate()[0].decode('ascii').split()
+
+        self.assertEqual(magic_loaded, 'False')
+        self.assertEqual(south_loaded, 'False')
+        self.assertTrue(float(seconds) < 2, 'Importing validatedfile.fields took %s seconds' % seconds)
+
+
+    def test_signatures_short_buffer(self):
+        self.assertEqual(match_signature(b'GIF8'), None)
+        self.assertEqual(match_signature(b'GIF89a'), 'image/gif')
+        self.assertEqual(match_signature(b''), None)
+
+
+    def test_sniff_length(self):
+        self.assertEqual(TestModel._meta.get_field('the_file').sniff_length, 8)
+        self.assertEqual(TestElement._meta.get_field('the_file').sniff_length, 8)
+        self.assertEqual(TestModelNoValidate._meta.get_field('the_file').sniff_length, 4096)
+
+
+    def test_content_type_policy(self):
+        policy = ContentTypePolicy(['image/*', 'application/pdf'])
+        self.assertTrue('image/png' in policy)
+        self.assertTrue('image/x-ms-bmp' in policy)
+        self.assertTrue('Application/PDF; charset=binary' in policy)
+        self.assertFalse('application/msword' in policy)
+        self.assertFalse(None in policy)
+        self.assertEqual(policy.listed_types(), None)
+
+        policy = ContentTypePolicy(['image/jpg', 'image/png'])
+        self.assertTrue('image/jpeg' in policy)
+        self.assertTrue('image/pjpeg' in policy)
+        self.assertEqual(policy.listed_types(), frozenset(['image/jpeg', 'image/png']))
+        self.assertTrue('application/zip' in ContentTypePolicy(['*/*']))
+        self.assertFalse(ContentTypePolicy())
+
+        self.assertEqual(ValidatedFileField(content_types = ['image/jpg', 'image/png']).sniff_length, 8)
+        self.assertEqual(ValidatedFileField(content_types = ['image/*']).sniff_length, 4096)
+
+
+    def test_content_type_wildcard(self):
+        field = ValidatedFileField(content_types = ['image/*'])
+        field.validate_file(self._create_uploaded_file('image2k.png'))
+        try:
+            field.validate_file(self._create_uploaded_file('document1k.pdf'))
+            self.fail('The pdf file was accepted')
+        except ValidationError as e:
+            self.assertEqual(e.messages, [u'Files of type application/pdf are not supported.'])
+
+
+    def test_check_extension(self):
+        field = ValidatedFileField(content_types = ['image/png', 'application/pdf'], check_extension = True)
+        field.validate_file(self._create_uploaded_file('image2k.png'))
+
+        content = self._get_sample_file('image2k.png').read()
+        try:
+            field.validate_file(SimpleUploadedFile(name = 'the_file.pdf', content = content))
+            self.fail('The png file named .pdf was accepted')
+        except ValidationError as e:
+            self.assertEqual(e.messages, [u'The extension of the file does not match its type image/png.'])
+
+        # Without the option only the content decides
+        field = ValidatedFileField(content_types = ['image/png'])
+        field.validate_file(SimpleUploadedFile(name = 'the_file.pdf', content = content))
+
+
+    def test_clean_valid_file(self):
+        # Without a stage reading the whole file the type is only peeked at
+        instance = TestModel(the_file = self._create_uploaded_file('image2k.png'))
+        field = TestModel._meta.get_field('the_file')
+        self.assertEqual(field.clean(instance.the_file, instance), instance.the_file)
+        instance.full_clean()
+
+
+    def test_sniff_content_type(self):
+        field = TestModel._meta.get_field('the_file')
+        for filename in os.listdir(self.SAMPLE_FILES_PATH):
+            content = self._get_sample_file(filename).read()
+            uploaded_file = SimpleUploadedFile(name = filename, content = content)
+            self.assertEqual(field.sniff_content_type(uploaded_file),
+                             detector_pool.get().from_buffer(content[:4096]))
+            self.assertEqual(uploaded_file.tell(), 0)
+
+
+    def test_peek_in_memory_file(self):
+        content = self._get_sample_file('image2k.png').read()
+        uploaded_file = SimpleUploadedFile(name = 'the_file.png', content = content)
+        uploaded_file.seek(100)
+        self.assertEqual(peek(uploaded_file, 8), content[:8])
+        self.assertEqual(peek(uploaded_file, 4096), content[:4096])
+        self.assertEqual(uploaded_file.tell(), 100)
+        self.assertTrue(reusable_buffer(4096) is reusable_buffer(4096))
+
+
+    def test_peek_temporary_file(self):
+        content = self._get_sample_file('document1k.pdf').read()
+        uploaded_file = TemporaryUploadedFile('the_file.pdf', 'application/pdf', len(content), None)
+        uploaded_file.write(content)
+        uploaded_file.seek(10)
+        self.assertEqual(peek(uploaded_file, 8), content[:8])
+        self.assertEqual(peek(uploaded_file, 4096), content[:4096])
+        self.assertEqual(uploaded_file.tell(), 10)
+        self.assertEqual(TestModel._meta.get_field('the_file').sniff_content_type(uploaded_file),
+                         'application/pdf')
+        self.assertEqual(uploaded_file.tell(), 10)
+        uploaded_file.close()
+
+
+    def test_peek_unseekable_file(self):
+        class Stream(object):
+            def __init__(self, content):
+                self.content = content
+
+            def read(self, length = None):
+                content, self.content = self.content[:length], self.content[length or len(self.content):]
+                return content
+
+        stream = Stream(b'%PDF-1.4')
+        self.assertRaises(IOError, peek, stream, 4)
+        self.assertEqual(stream.read(), b'%PDF-1.4')
+
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size = 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+
+    @override_settings(VALIDATEDFILE_DETECTION_CACHE = {'BACKEND': 'memory', 'MAX_SIZE': 10})
+    def test_detection_cache(self):
+        reset_detection_cache()
+        try:
+            field = TestModel._meta.get_field('the_file')
+            content = self._get_sample_file('document15k.doc').read()
+            for i in range(3):
+                uploaded_file = SimpleUploadedFile(name = 'the_file.doc', content = content)
+                field.sniff_content_type(uploaded_file)
+            cache = get_detection_cache()
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+        finally:
+            reset_detection_cache()
+
+
+    def test_shared_detection_cache(self):
+        path = tempfile.mktemp(suffix = '.sqlite3')
+        content = self._get_sample_file('document15k.doc').read()
+        results = multiprocessing.Queue()
+        try:
+            with override_settings(VALIDATEDFILE_DETECTION_CACHE = {'BACKEND': 'sqlite', 'PATH': path}):
+                reset_detection_cache()
+                # Each worker process opens the cache file on its own
+                for i in range(2):
+                    worker = multiprocessing.Process(target = _sniff_in_worker, args = (content, results))
+                    worker.start()
+                    worker.join()
+                self.assertEqual([results.get(), results.get()], [(0, 1), (1, 0)])
+        finally:
+            reset_detection_cache()
+            for name in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+    def test_sqlite_cache_expiry(self):
+        path = tempfile.mktemp(suffix = '.sqlite3')
+        try:
+            cache = SQLiteCache(path, timeout = 0.2)
+            cache.set('key', 'image/png')
+            self.assertEqual(cache.get('key'), 'image/png')
+            time.sleep(0.3)
+            self.assertEqual(cache.get('key'), None)
+
+            cache.set('key', 'image/png')
+            cache.delete('key')
+            self.assertEqual(cache.get('key'), None)
+
+            # add() keeps a live entry and replaces an expired one
+            self.assertTrue(cache.add('key', 'image/png'))
+            self.assertFalse(cache.add('key', 'image/gif'))
+            self.assertEqual(cache.get('key'), 'image/png')
+            time.sleep(0.3)
+            self.assertTrue(cache.add('key', 'image/gif'))
+            self.assertEqual(cache.get('key'), 'image/gif')
+        finally:
+            for name in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+    @override_settings(VALIDATEDFILE_USAGE_CACHE = {'BACKEND': 'django'})
+    def test_usage_cache(self):
+        reset_usage_cache()
+        try:
+            get_usage_cache().clear()
+            container = self._create_container(name = 'container1')
+            quota = FileQuota()
+            quota.update_from_usage(container)
+            self.assertEqual(quota.current_usage, 0)
+
+            # Saving a file of the owner invalidates the cached total, which
+            # is not cached again before the transaction commits
+            element = self._add_element(container = container,
+                                        orig_filename = 'image2k.png',
+                                        dest_filename = 'the_file.png')
+            quota.update_from_usage(container)
+            self.assertEqual(quota.current_usage, 2120)
+            self.assertNumQueries(1, quota.update_from_usage, container)
+
+            get_usage_cache().delete(usage_key(TestContainer, container.pk))
+            quota.update_from_usage(container)
+            self.assertNumQueries(0, quota.update_from_usage, container)
+            self.assertEqual(quota.current_usage, 2120)
+
+            # A total read before the marker was written does not replace it
+            FileUsage.objects.forget_usage(TestContainer, container.pk)
+            get_usage_cache().add(usage_key(TestContainer, container.pk), 0)
+            quota.update_from_usage(container)
+            self.assertEqual(quota.current_usage, 2120)
+
+            element.the_file.delete()
+            element.delete()
+            quota.update_from_usage(container)
+            self.assertEqual(quota.current_usage, 0)
+            container.delete()
+        finally:
+            reset_usage_cache()
+
+
+    @override_settings(VALIDATEDFILE_USAGE_CACHE = {'BACKEND': 'memory'})
+    def test_usage_cache_not_shared(self):
+        reset_usage_cache()
+        try:
+            self.assertRaises(ValueError, get_usage_cache)
+        finally:
+            reset_usage_cache()
+
+
+    def test_validate_many(self):
+        field = TestModel._meta.get_field('the_file')
+        files = [self._create_uploaded_file('image2k.png'),
+                 self._create_uploaded_file('document1k.pdf'),
+                 self._create_uploaded_file('image15k.png'),
+                 self._create_uploaded_file('image2k.png')]
+        errors = field.validate_many(files, workers = 2)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(errors[0], None)
+        self.assertEqual(errors[1].messages, [u'Files of type application/pdf are not supported.'])
+        self.assertEqual(errors[2].messages,
+                [u'Files of size greater than 10.0 KB are not allowed. Your file is 14.2 KB'])
+        self.assertEqual(errors[3], None)
+
+
+    def test_validate_many_quota(self):
+        field = TestModel._meta.get_field('the_file')
+        files = [self._create_uploaded_file('image2k.png'),
+                 self._create_uploaded_file('document1k.pdf'),
+                 self._create_uploaded_file('image2k.png')]
+
+        errors = field.validate_many(files, quota_validator = QuotaValidator(max_usage = 5000))
+        self.assertEqual(errors[0], None)
+        self.assertEqual(errors[2], None)
+
+        errors = field.validate_many(files, quota_validator = QuotaValidator(max_usage = 3000))
+        self.assertEqual(errors[0].messages,
+                [u'Please keep the total uploaded files under 2.9 KB. With this file, the total would be 4.1 KB.'])
+        self.assertEqual(errors[1].messages, [u'Files of type application/pdf are not supported.'])
+        self.assertEqual(errors[2].messages, errors[0].messages)
+
+
+    def test_validate_file_async(self):
+        field = TestModel._meta.get_field('the_file')
+        filenames = ['image2k.png', 'document1k.pdf', 'image15k.png'] * 4
+        results = [field.validate_file_async(self._create_uploaded_file(filename))
+                   for filename in filenames]
+        errors = [result.get(timeout = 10) for result in results]
+        for filename, error in zip(filenames, errors):
+            if filename == 'image2k.png':
+                self.assertEqual(error, None)
+            else:
+                self.assertEqual(len(error.messages), 1)
+
+
+    def test_validate_file_async_callback_error(self):
+        field = TestModel._meta.get_field('the_file')
+
+        def callback(error):
+            raise RuntimeError('Broken callback')
+
+        field.validate_file_async(self._create_uploaded_file('image2k.png'), callback).get(timeout = 10)
+        # The pool shared with validate_many still hands out results
+        files = [self._create_uploaded_file('image2k.png') for i in range(4)]
+        result = background_pool().apply_async(field.validate_many, (files, 4))
+        self.assertEqual(result.get(timeout = 10), [None] * 4)
+
+
+    def test_update_quota_async(self):
+        container = self._create_container(name = 'container1')
+        element = self._add_element(container = container,
+                                    orig_filename = 'image2k.png',
+                                    dest_filename = 'the_file.png')
+
+        validator = QuotaValidator(max_usage = 1000)
+        validator.update_quota_async(list(container.test_elements.all()), 'the_file').get(timeout = 10)
+        self.assertEqual(validator.quota.current_usage, 2120)
+        self.assertTrue(validator.quota.exceeds())
+
+        element.the_file.delete()
+        element.delete()
+        container.delete()
+
+
+    def test_upload_handler_ok(self):
+        handler = self._create_upload_handler()
+        content = self._get_sample_file('image2k.png').read()
+        handler.new_file('the_file', 'the_file.png', 'image/png', None)
+        self.assertEqual(handler.receive_data_chunk(content[:1024], 0), content[:1024])
+        self.assertEqual(handler.receive_data_chunk(content[1024:], 1024), content[1024:])
+        self.assertEqual(handler.file_complete(len(content)), None)
+        self.assertEqual(handler.errors, {})
+
+
+    def test_upload_handler_invalid_filetype(self):
+        handler = self._create_upload_handler()
+        content = self._get_sample_file('document15k.pdf').read()
+        handler.new_file('the_file', 'the_file.png', 'image/png', None)
+        self.assertEqual(handler.receive_data_chunk(content[:4096], 0), None)
+        self.assertEqual(handler.receive_data_chunk(content[4096:], 4096), None)
+        self.assertEqual(handler.errors['the_file'],
+                [u'Files of type application/pdf are not supported.'])
+
+        rejected = handler.file_complete(len(content))
+        self.assertTrue(isinstance(rejected, RejectedUpload))
+        self.assertEqual((rejected.name, rejected.size, rejected.read()), ('the_file.png', len(content), b''))
+        field = TestModel._meta.get_field('the_file')
+        try:
+            field.validate_file(rejected)
+            self.fail('The rejected file was accepted')
+        except ValidationError as e:
+            self.assertEqual(e.messages, [u'Files of type application/pdf are not supported.'])
+
+
+    def test_upload_handler_invalid_size(self):
+        handler = self._create_upload_handler()
+        content = self._get_sample_file('image15k.png').read()
+        handler.new_file('the_file', 'the_file.png', 'image/png', None)
+        handler.receive_data_chunk(content[:8192], 0)
+        self.assertEqual(handler.receive_data_chunk(content[8192:], 8192), None)
+        self.assertEqual(handler.file_complete(len(content)).upload_errors,
+                [u'Files of size greater than 10.0 KB are not allowed. Your file is 14.2 KB'])
+        self.assertEqual(handler.errors['the_file'],
+                [u'Files of size greater than 10.0 KB are not allowed. Your file is 14.2 KB'])
+
+
+    def test_upload_handler_abort(self):
+        handler = self._create_upload_handler(abort = True)
+        content = self._get_sample_file('document1k.pdf').read()
+        handler.new_file('the_file', 'the_file.pdf', 'application/pdf', None)
+        self.assertRaises(StopUpload, handler.receive_data_chunk, content, 0)
+
+
+    def test_upload_handler_ignores_other_fields(self):
+        handler = self._create_upload_handler()
+        content = self._get_sample_file('document1k.pdf').read()
+        handler.new_file('other_file', 'the_file.pdf', 'application/pdf', None)
+        self.assertEqual(handler.receive_data_chunk(content, 0), content)
+
+
+    def test_metrics_validation(self):
+        collector = RecordingCollector()
+        set_collector(collector)
+        try:
+            form = self._create_bound_test_model_form(form_class = TestModelForm,
+                                                      orig_filename = 'image2k.png',
+                                                      dest_filename = 'the_file.png',
+                                                      content_type = 'image/png')
+            self.assertTrue(form.is_valid())
+            self.assertEqual(collector.counters['bytes_read'], 8)
+            self.assertEqual(collector.events, [('content_type', 'image/png')])
+            self.assertEqual(set(collector.timings), set(['read', 'detect', 'size_check']))
+
+            collector.reset()
+            form = self._create_bound_test_model_form(form_class = TestModelForm,
+                                                      orig_filename = 'image15k.png',
+                                                      dest_filename = 'the_file.png',
+                                                      content_type = 'image/png')
+            self.assertFalse(form.is_valid())
+            self.assertEqual(collector.events, [('content_type', 'image/png'), ('rejected', 'size')])
+        finally:
+            set_collector(None)
+
+
+    def test_metrics_quota(self):
+        container = self._create_container(name = 'container1')
+        element1 = self._add_element(container = container,
+                                     orig_filename = 'image2k.png',
+                                     dest_filename = 'the_file1.png')
+        element2 = self._add_element(container = container,
+                                     orig_filename = 'image2k.png',
+                                     dest_filename = 'the_file2.png')
+
+        collector = RecordingCollector()
+        set_collector(collector)
+        try:
+            quota = FileQuota()
+            quota.update(container.test_elements.all(), 'the_file')
+            self.assertEqual(collector.counters['storage_size_calls'], 2)
+            self.assertEqual(len(collector.timings['quota_update']), 1)
+
+            collector.reset()
+            quota.update_from_queryset(container.test_elements.all(), 'the_file')
+            self.assertEqual(collector.counters.get('storage_size_calls', 0), 0)
+        finally:
+            set_collector(None)
+
+        element1.the_file.delete()
+        element2.the_file.delete()
+        element1.delete()
+        element2.delete()
+        container.delete()
+
+
+    def test_digest_on_clean(self):
+        content = self._get_sample_file('document1k.pdf').read()
+        instance = TestDocument(the_file = SimpleUploadedFile(name = 'the_file.pdf', content = content))
+        field = TestDocument._meta.get_field('the_file')
+        field.clean(instance.the_file, instance)
+        self.assertEqual(instance.the_file_digest, hashlib.sha256(content).hexdigest())
+        self.assertEqual(instance.the_file.file.tell(), 0)
+
+
+    def test_digest_deduplicates_storage(self):
+        content = self._get_sample_file('document1k.pdf').read()
+        digest = hashlib.sha256(content).hexdigest()
+        document1 = TestDocument.objects.create(
+                the_file = SimpleUploadedFile(name = 'the_file1.pdf', content = content))
+        document2 = TestDocument.objects.create(
+                the_file = SimpleUploadedFile(name = 'the_file2.pdf', content = content))
+        document3 = TestDocument.objects.create(
+                the_file = File(self._get_sample_file('document15k.pdf'), 'the_file3.pdf'))
+
+        self.assertEqual(document1.the_file_digest, digest)
+        self.assertEqual(document1.the_file.name, 'documents/%s/%s.pdf' % (digest[:2], digest))
+        self.assertEqual(document2.the_file.name, document1.the_file.name)
+        self.assertNotEqual(document3.the_file.name, document1.the_file.name)
+
+        quota = FileQuota()
+        quota.update_from_queryset(TestDocument.objects.all(), 'the_file', distinct = True)
+        self.assertEqual(quota.current_usage, len(content) + document3.the_file_size)
+        quota.update_from_queryset(TestDocument.objects.all(), 'the_file')
+        self.assertEqual(quota.current_usage, 2 * len(content) + document3.the_file_size)
+
+        for document in (document1, document3):
+            os.remove(document.the_file.path)
+        TestDocument.objects.all().delete()
+
+
+    def test_pipeline_scanner(self):
+        scanner = FakeScanner()
+        scanner.start()
+        try:
+            field = ValidatedFileField(content_types = ['application/pdf'],
+                                       stages = [SocketScannerStage(scanner.server_address)])
+            content = self._get_sample_file('document15k.pdf').read()
+
+            field.validate_file(SimpleUploadedFile(name = 'the_file.pdf', content = content))
+            self.assertEqual(scanner.scanned, [len(content)])
+
+            infected_file = SimpleUploadedFile(name = 'the_file.pdf', content = content + b'INFECTED')
+            try:
+                field.validate_file(infected_file)
+                self.fail("The infected file was accepted")
+            except ValidationError as e:
+                self.assertEqual(e.messages, [u'The file did not pass the content scan (Test-Signature).'])
+
+            wrong_file = SimpleUploadedFile(name = 'the_file.png',
+                                            content = self._get_sample_file('image2k.png').read())
+            self.assertRaises(ValidationError, field.validate_file, wrong_file)
+            self.assertEqual(len(scanner.scanned), 2)
+        finally:
+            scanner.stop()
+
+
+    def test_pipeline_reads_once_and_stops_early(self):
+        class CountingStage(ValidationStage):
+            needs_stream = True
+            chunks = []
+
+            def feed(self, chunk):
+                self.chunks.append(len(chunk))
+                return True
+
+        class FailingStage(ValidationStage):
+            def __init__(self, hard):
+                self.hard = hard
+
+            def start(self, field, file, streaming):
+                raise ValidationError(u'Failed')
+
+        content = self._get_sample_file('document15k.pdf').read()
+        field = ValidatedFileField(stages = [CountingStage(), CountingStage(), FailingStage(hard = False)])
+        self.assertRaises(ValidationError, field.validate_file,
+                          SimpleUploadedFile(name = 'the_file.pdf', content = content))
+        self.assertEqual(sum(CountingStage.chunks), 2 * len(content))
+
+        CountingStage.chunks = []
+        field = ValidatedFileField(stages = [FailingStage(hard = True), CountingStage()])
+        self.assertRaises(ValidationError, field.validate_file,
+                          SimpleUploadedFile(name = 'the_file.pdf', content = content))
+        self.assertEqual(CountingStage.chunks, [])
+
+
+    def test_pipeline_stops_early_on_size(self):
+        class CountingStage(ValidationStage):
+            needs_stream = True
+            chunks = []
+
+            def feed(self, chunk):
+                self.chunks.append(len(chunk))
+                return True
+
+        # The type is decided within the first chunk, and the size right after
+        content = self._get_sample_file('image2k.png').read() + b'\0' * (1024 * 1024)
+        field = ValidatedFileField(content_types = ['image/png'], max_upload_size = 10240,
+                                   digest_field = 'the_file_digest', stages = [CountingStage()])
+        uploaded_file = SimpleUploadedFile(name = 'the_file.png', content = content)
+        try:
+            field.validate_file(uploaded_file)
+            self.fail('The oversize file was accepted')
+        except ValidationError as e:
+            self.assertEqual(e.messages, [u'Files of size greater than 10.0 KB are not allowed. Your file is 1.0 MB'])
+        self.assertTrue(sum(CountingStage.chunks) <= uploaded_file.DEFAULT_CHUNK_SIZE)
+
+
+    def test_image_dimensions(self):
+        self.assertEqual(image_dimensions(self._get_sample_file('image2k.png').read(4096)), (500, 500))
+        self.assertEqual(image_dimensions(b'GIF89a\x10\x00\x20\x00'), (16, 32))
+        self.assertEqual(image_dimensions(b'GIF89a\x10'), INCOMPLETE)
+        self.assertEqual(image_dimensions(b'RIFF\x00\x00\x00\x00WEBPVP8X\x0a\x00\x00\x00\x00\x00\x00\x00'
+                                          b'\x1f\x03\x00\xdf\x01\x00'), (800, 480))
+        self.assertEqual(image_dimensions(self._create_jpeg(256, 512, 100)), (512, 256))
+        self.assertEqual(image_dimensions(self._create_jpeg(256, 512, 100)[:100]), INCOMPLETE)
+        self.assertEqual(image_dimensions(self._get_sample_file('document1k.pdf').read(4096)), None)
+
+
+    def test_form_image_dimensions(self):
+        field = ValidatedFileField(max_dimensions = (1000, 1000))
+        field.validate_file(self._create_uploaded_file('image2k.png'))
+        try:
+            field.validate_file(self._create_uploaded_file('image15k.png'))
+            self.fail("The large image was accepted")
+        except ValidationError as e:
+            self.assertEqual(e.messages,
+                    [u'Images larger than 1000x1000 pixels are not allowed. Your image is 3000x3000'])
+        field.validate_file(self._create_uploaded_file('document1k.pdf'))
+
+
+    def test_form_image_pixels(self):
+        field = ValidatedFileField(max_pixels = 1000000)
+        field.validate_file(self._create_uploaded_file('image2k.png'))
+        try:
+            field.validate_file(self._create_uploaded_file('image15k.png'))
+            self.fail("The large image was accepted")
+        except ValidationError as e:
+            self.assertEqual(e.messages,
+                    [u'Images of more than 1000000 pixels are not allowed. Your image has 9000000'])
+
+
+    def test_form_image_dimensions_jpeg_bounded_read(self):
+        content = self._create_jpeg(20000, 20000, 10000)
+        field = ValidatedFileField(max_pixels = 1000000)
+        self.assertRaises(ValidationError, field.validate_file,
+                          SimpleUploadedFile(name = 'the_file.jpg', content = content))
+
+        field = ValidatedFileField(max_pixels = 1000000, stages = [])
+        field.pipeline.stages[0].header_length = 8192
+        try:
+            field.validate_file(SimpleUploadedFile(name = 'the_file.jpg', content = content))
+            self.fail("The image with unreadable dimensions was accepted")
+        except ValidationError as e:
+            self.assertEqual(e.messages, [u'The dimensions of the image could not be read.'])
+
+
+    def test_archive_ok(self):
+        field = ValidatedFileField(archive_member_types = ['image/png', 'application/pdf'],
+                                   archive_max_members = 2,
+                                   archive_max_size = 20000,
+                                   archive_max_ratio = 100)
+        field.validate_file(self._create_zip_file([('image.png', 'image2k.png'),
+                                                   ('document.pdf', 'document1k.pdf')]))
+        field.validate_file(self._create_uploaded_file('image2k.png'))
+
+
+    def test_archive_invalid_member_type(self):
+        field = ValidatedFileField(archive_member_types = ['image/png'])
+        self._assert_archive_error(field,
+                self._create_zip_file([('image.png', 'image2k.png'), ('document.pdf', 'document1k.pdf')]),
+                u'Archive files of type application/pdf are not supported.')
+
+
+    def test_archive_too_many_members(self):
+        field = ValidatedFileField(archive_max_members = 2)
+        self._assert_archive_error(field,
+                self._create_zip_file([('image%d.png' % i, 'image2k.png') for i in range(3)]),
+                u'Archives with more than 2 files are not allowed.')
+
+
+    def test_archive_too_large(self):
+        field = ValidatedFileField(archive_max_size = 10000)
+        self._assert_archive_error(field,
+                self._create_zip_file([('image.png', 'image15k.png')]),
+                u'Archives with more than 9.8 KB of uncompressed content are not allowed.')
+
+
+    def test_archive_bomb(self):
+        field = ValidatedFileField(archive_max_ratio = 100)
+        content = io.BytesIO()
+        archive = zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('zeros.bin', b'\0' * 10000000)
+        archive.close()
+        self._assert_archive_error(field,
+                SimpleUploadedFile(name = 'bomb.zip', content = content.getvalue()),
+                u'Archive files compressed more than 100 times are not allowed.')
+
+
+    def test_archive_corrupt(self):
+        field = ValidatedFileField(archive_max_members = 10)
+        self._assert_archive_error(field,
+                SimpleUploadedFile(name = 'corrupt.zip', content = b'PK\x03\x04' + b'\0' * 100),
+                u'The archive is corrupt.')
+
+
+    def test_stored_file_ranged_read(self):
+        instance = TestRemoteModel.objects.create(
+                the_file = File(self._get_sample_file('image2k.png'), 'the_file.png'))
+        instance = TestRemoteModel.objects.get(pk = instance.pk)
+        field = instance._meta.get_field('the_file')
+        size = instance.the_file.size
+
+        # Only the signature bytes are transferred; the size comes from metadata
+        counting_storage.bytes_transferred = 0
+        instance.full_clean()
+        self.assertEqual(counting_storage.bytes_transferred, field.sniff_length)
+
+        # Validating through the opened file downloads all of it
+        counting_storage.bytes_transferred = 0
+        field.validate_file(instance.the_file.file)
+        instance.the_file.close()
+        self.assertEqual(counting_storage.bytes_transferred, size)
+
+        # Storages without read_range are opened and read from there
+        counting_storage.read_range = None
+        try:
+            counting_storage.bytes_transferred = 0
+            instance.full_clean()
+            self.assertEqual(counting_storage.bytes_transferred, size)
+        finally:
+            del counting_storage.read_range
+
+        instance.the_file.delete()
+        instance.delete()
+
+
+    def test_stages_share_peeked_prefix(self):
+        name = counting_storage.save('testfile/the_file.png', File(self._get_sample_file('image2k.png')))
+        field = ValidatedFileField(storage = counting_storage, content_types = ['image/png'],
+                                   max_dimensions = (1000, 1000))
+
+        # The type and the dimensions are read from a single ranged read
+        counting_storage.bytes_transferred = 0
+        field.validate_file(StoredFile(counting_storage, name))
+        self.assertEqual(counting_storage.bytes_transferred, counting_storage.size(name))
+        counting_storage.delete(name)
+
+
+    @override_settings(VALIDATEDFILE_DEFERRED_RUNNER = 'sync')
+    def test_deferred_validation(self):
+        reset_runner()
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append((sender, kwargs['status'], kwargs['errors']))
+
+        file_validated.connect(receiver)
+        try:
+            content = self._get_sample_file('document1k.pdf').read()
+            accepted = TestDeferredModel.objects.create(
+                    the_file = SimpleUploadedFile(name = 'the_file.pdf', content = content))
+            quarantined = TestDeferredModel.objects.create(
+                    the_file = SimpleUploadedFile(name = 'the_file.pdf', content = content[:-200]))
+
+            self.assertEqual(TestDeferredModel.objects.get(pk = accepted.pk).the_file_status, ACCEPTED)
+            self.assertEqual(TestDeferredModel.objects.get(pk = quarantined.pk).the_file_status, QUARANTINED)
+            self.assertEqual(received, [
+                (TestDeferredModel, ACCEPTED, []),
+                (TestDeferredModel, QUARANTINED, [u'The PDF file is damaged.']),
+            ])
+        finally:
+            file_validated.disconnect(receiver)
+            reset_runner()
+
+        for instance in (accepted, quarantined):
+            instance.the_file.delete()
+            instance.delete()
+
+
+    @override_settings(VALIDATEDFILE_DEFERRED_RUNNER = 'sync')
+    def test_deferred_validation_error(self):
+        class BrokenStage(ValidationStage):
+            needs_stream = True
+
+            def feed(self, chunk):
+                raise IOError('Connection lost')
+
+        reset_runner()
+        field = TestDeferredModel._meta.get_field('the_file')
+        stages = field.deep_pipeline.stages
+        field.deep_pipeline.stages = [BrokenStage()]
+        try:
+            # An unexpected error quarantines the file instead of leaving it pending
+            instance = TestDeferredModel.objects.create(the_file = self._create_uploaded_file('document1k.pdf'))
+            self.assertEqual(TestDeferredModel.objects.get(pk = instance.pk).the_file_status, QUARANTINED)
+        finally:
+            field.deep_pipeline.stages = stages
+            reset_runner()
+
+        instance.the_file.delete()
+        instance.delete()
+
+
+    def test_deferred_validation_replaced(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs['status'])
+
+        instance = TestDeferredModel.objects.create()
+        TestDeferredModel.objects.filter(pk = instance.pk).update(the_file = 'testfile/new.pdf',
+                                                                  the_file_status = 'pending')
+        retry_delays = deferred.RETRY_DELAYS
+        deferred.RETRY_DELAYS = ()
+        file_validated.connect(receiver)
+        try:
+            # The result of the old file is neither stored nor sent
+            finish_deep_validation(TestDeferredModel, instance.pk, 'the_file', 'testfile/old.pdf', [])
+            self.assertEqual(TestDeferredModel.objects.get(pk = instance.pk).the_file_status, 'pending')
+            self.assertEqual(received, [])
+
+            finish_deep_validation(TestDeferredModel, instance.pk, 'the_file', 'testfile/new.pdf', [])
+            self.assertEqual(TestDeferredModel.objects.get(pk = instance.pk).the_file_status, ACCEPTED)
+            self.assertEqual(received, [ACCEPTED])
+        finally:
+            file_validated.disconnect(receiver)
+            deferred.RETRY_DELAYS = retry_delays
+        instance.delete()
+
+
+    def test_deferred_validation_pending(self):
+        field = TestDeferredModel._meta.get_field('the_file')
+        instance = TestDeferredModel(the_file = self._create_uploaded_file('document1k.pdf'))
+        self.assertEqual(instance.the_file_status, 'pending')
+        field.clean(instance.the_file, instance)
+
+
     def test_quota_empty(self):
         container = self._create_container(name = 'container1')
 
@@ -166,6 +1057,157 @@ class ValidatedFileFieldTest(TestCase):
         container2.delete()
 
 
+    def test_quota_for_owners(self):
+        container1 = self._create_container(name = 'container1')
+        container2 = self._create_container(name = 'container2')
+        container3 = self._create_container(name = 'container3')
+        elements = [
+            self._add_element(container = container1, orig_filename = 'image2k.png',
+                              dest_filename = 'the_file1.png'),
+            self._add_element(container = container1, orig_filename = 'image15k.png',
+                              dest_filename = 'the_file2.png'),
+            self._add_element(container = container2, orig_filename = 'document15k.pdf',
+                              dest_filename = 'the_file3.pdf'),
+        ]
+        # Saved before the size column existed
+        TestElement.objects.filter(pk = elements[1].pk).update(the_file_size = None)
+
+        collector = RecordingCollector()
+        set_collector(collector)
+        try:
+            quotas = FileQuota.for_owners(TestContainer.objects.all(), 'test_elements', 'the_file',
+                                          max_usage = 20000)
+        finally:
+            set_collector(None)
+
+        self.assertEqual(collector.counters['storage_size_calls'], 1)
+        self.assertEqual(sorted(quotas.keys()), [container1.pk, container2.pk, container3.pk])
+        self.assertEqual(quotas[container1.pk].current_usage, 16706)
+        self.assertEqual(quotas[container2.pk].current_usage, elements[2].the_file.size)
+        self.assertEqual(quotas[container3.pk].current_usage, 0)
+        self.assertTrue(quotas[container1.pk].near_limit())
+        self.assertFalse(quotas[container1.pk].exceeds())
+        self.assertAlmostEqual(quotas[container1.pk].percentage(), 83.53)
+        self.assertEqual(quotas[container3.pk].percentage(), 0)
+
+        for element in elements:
+            element.the_file.delete()
+            element.delete()
+        for container in (container1, container2, container3):
+            container.delete()
+
+
+    def test_quota_unlimited(self):
+        quota = FileQuota()
+        quota.current_usage = 2120
+        self.assertFalse(quota.exceeds())
+        self.assertFalse(quota.near_limit())
+        self.assertEqual(quota.percentage(), None)
+
+        quota = FileQuota(max_usage = 0)
+        self.assertFalse(quota.near_limit())
+        self.assertEqual(quota.percentage(), 100)
+        quota.current_usage = 2120
+        self.assertTrue(quota.exceeds())
+        self.assertTrue(quota.near_limit())
+
+
+    def test_quota_reservations_concurrent(self):
+        container = self._create_container(name = 'container1')
+        connection = connections['default']
+        reservations = []
+
+        def upload():
+            connections['default'] = connection
+            reservations.append(FileUsage.objects.reserve(TestContainer, container.pk, 1000,
+                                                          max_usage = 10000))
+
+        # The threads share the test database connection
+        connection.allow_thread_sharing = True
+        try:
+            threads = [threading.Thread(target = upload) for i in range(30)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            connection.allow_thread_sharing = False
+
+        granted = [reservation for reservation in reservations if reservation is not None]
+        self.assertEqual(len(reservations), 30)
+        self.assertEqual(len(granted), 10)
+        usage = FileUsage.objects.get(object_id = container.pk)
+        self.assertEqual((usage.usage, usage.reserved), (0, 10000))
+
+        for reservation in granted[:6]:
+            self.assertTrue(FileUsage.objects.commit_reservation(reservation))
+        for reservation in granted[6:]:
+            self.assertTrue(FileUsage.objects.release_reservation(reservation))
+        self.assertFalse(FileUsage.objects.release_reservation(granted[0]))
+        usage = FileUsage.objects.get(object_id = container.pk)
+        self.assertEqual((usage.usage, usage.reserved), (6000, 0))
+        self.assertEqual(QuotaReservation.objects.count(), 0)
+
+        # The room is checked by the database, without going through the files
+        self.assertNumQueries(3, FileUsage.objects.reserve, TestContainer, container.pk, 1000, 10000)
+
+        container.delete()
+
+
+    def test_quota_reservation_expiry(self):
+        container = self._create_container(name = 'container1')
+
+        abandoned = FileUsage.objects.reserve(TestContainer, container.pk, 8000, max_usage = 10000,
+                                              timeout = 0)
+        self.assertNotEqual(abandoned, None)
+        reservation = FileUsage.objects.reserve(TestContainer, container.pk, 5000, max_usage = 10000)
+        self.assertNotEqual(reservation, None)
+        self.assertFalse(FileUsage.objects.commit_reservation(abandoned))
+        self.assertEqual(FileUsage.objects.get(object_id = container.pk).reserved, 5000)
+
+        self.assertEqual(FileUsage.objects.reserve(TestContainer, container.pk, 6000, max_usage = 10000),
+                         None)
+        FileUsage.objects.release_reservation(reservation)
+        container.delete()
+
+
+    def test_quota_validator_reservation(self):
+        container = self._create_container(name = 'container1')
+        shared = QuotaValidator(max_usage = 10000)
+        validator = shared.reserve_for(container)
+        self.assertEqual(shared.owner, None)
+
+        uploaded_file = self._create_uploaded_file('image2k.png')
+        validator(uploaded_file)
+        self.assertEqual(FileUsage.objects.get(object_id = container.pk).reserved, 2120)
+
+        # Saving the file commits its reservation instead of adding the size again
+        element = container.test_elements.create(the_file = uploaded_file)
+        usage = FileUsage.objects.get(object_id = container.pk)
+        self.assertEqual((usage.usage, usage.reserved), (2120, 0))
+
+        self.assertRaises(ValidationError, validator, self._create_uploaded_file('image15k.png'))
+        self.assertEqual(FileUsage.objects.get(object_id = container.pk).reserved, 0)
+
+        element.the_file.delete()
+        element.delete()
+        container.delete()
+
+
+    def test_quota_reservation_released_on_invalid_file(self):
+        container = self._create_container(name = 'container1')
+        for filename in ('document1k.pdf', 'document1k.pdf', 'image2k.png'):
+            form = TestElementReservingForm(container, data = {},
+                                            files = {'the_file': self._create_uploaded_file(filename)})
+            self.assertEqual(form.is_valid(), filename.endswith('.png'))
+        # Only the valid upload still holds its room, until it is saved
+        self.assertEqual(FileUsage.objects.get(object_id = container.pk).reserved, 2120)
+
+        FileUsage.objects.release_reservation(form.cleaned_data['the_file'].quota_reservation)
+        self.assertEqual(FileUsage.objects.get(object_id = container.pk).reserved, 0)
+        container.delete()
+
+
     def test_quota_exceeds(self):
         quota = FileQuota(max_usage = 1000)
 
@@ -225,6 +1267,188 @@ class ValidatedFileFieldTest(TestCase):
         container.delete()
 
 
+    def test_quota_usage_counter(self):
+        container = self._create_container(name = 'container1')
+        quota = FileQuota()
+        quota.update_from_usage(container)
+        self.assertEqual(quota.current_usage, 0)
+
+        element1 = self._add_element(container = container,
+                                     orig_filename = 'image2k.png',
+                                     dest_filename = 'the_file1.png')
+        element2 = self._add_element(container = container,
+                                     orig_filename = 'image15k.png',
+                                     dest_filename = 'the_file2.png')
+        quota.update_from_usage(container)
+        self.assertEqual(quota.current_usage, 16706)
+
+        element1 = TestElement.objects.get(pk = element1.pk)
+        element1.the_file.delete()
+        quota.update_from_usage(container)
+        self.assertEqual(quota.current_usage, 14586)
+
+        element2.the_file.delete(save = False)
+        element2.the_file = File(self._get_sample_file('image2k.png'), 'the_file3.png')
+        element2.save()
+        quota.update_from_usage(container)
+        self.assertEqual(quota.current_usage, 2120)
+
+        element2 = TestElement.objects.get(pk = element2.pk)
+        element2.delete()
+        quota.update_from_usage(container)
+        self.assertEqual(quota.current_usage, 0)
+
+        element2.the_file.delete(save = False)
+        element1.delete()
+        container.delete()
+
+
+    def test_size_field_on_init(self):
+        # The size column is declared after the file, and set by the constructor
+        element = TestElement(the_file = self._create_uploaded_file('image2k.png'))
+        self.assertEqual(element.the_file_size, 2120)
+        element = TestElement(the_file = self._create_uploaded_file('image2k.png'), the_file_size = 1)
+        self.assertEqual(element.the_file_size, 2120)
+
+
+    def test_quota_size_field(self):
+        container = self._create_container(name = 'container1')
+        element1 = self._add_element(container = container,
+                                     orig_filename = 'image2k.png',
+                                     dest_filename = 'the_file1.png')
+        element2 = self._add_element(container = container,
+                                     orig_filename = 'image15k.png',
+                                     dest_filename = 'the_file2.png')
+        self.assertEqual(TestElement.objects.get(pk = element1.pk).the_file_size, 2120)
+        self.assertEqual(TestElement.objects.get(pk = element2.pk).the_file_size, 14586)
+
+        quota = FileQuota()
+        quota.update_from_queryset(container.test_elements.all(), 'the_file')
+        self.assertEqual(quota.current_usage, 16706)
+
+        TestElement.objects.filter(pk = element2.pk).update(the_file_size = None)
+        quota.update_from_queryset(container.test_elements.all(), 'the_file')
+        self.assertEqual(quota.current_usage, 16706)
+
+        element1.the_file.delete()
+        self.assertEqual(TestElement.objects.get(pk = element1.pk).the_file_size, None)
+        quota.update_from_queryset(container.test_elements.all(), 'the_file')
+        self.assertEqual(quota.current_usage, 14586)
+
+        element2.the_file.delete()
+        element1.delete()
+        element2.delete()
+        container.delete()
+
+
+    def test_rebuild_file_usage(self):
+        container = self._create_container(name = 'container1')
+        element = self._add_element(container = container,
+                                    orig_filename = 'image2k.png',
+                                    dest_filename = 'the_file.png')
+        FileUsage.objects.all().delete()
+
+        call_command('rebuild_file_usage')
+        quota = FileQuota()
+        quota.update_from_usage(container)
+        self.assertEqual(quota.current_usage, 2120)
+
+        element.the_file.delete()
+        element.delete()
+        container.delete()
+
+
+    def test_audit_validated_files(self):
+        container = self._create_container(name = 'container1')
+        elements = [
+            self._add_element(container = container, orig_filename = 'image2k.png',
+                              dest_filename = 'the_file.png'),
+            self._add_element(container = container, orig_filename = 'document1k.pdf',
+                              dest_filename = 'the_file.pdf'),
+            self._add_element(container = container, orig_filename = 'image15k.png',
+                              dest_filename = 'the_file.png'),
+        ]
+        TestElement.objects.update(the_file_size = None)
+
+        class Output(list):
+            write = list.append
+
+        # A previous run stopped after the first row
+        checkpoint_path = tempfile.mktemp(suffix = '.json')
+        with open(checkpoint_path, 'w') as f:
+            json.dump({'testing.TestElement.the_file': elements[0].pk}, f)
+
+        output = Output()
+        call_command('audit_validated_files', 'testing.TestElement', batch_size = 1, workers = 2,
+                     checkpoint = checkpoint_path, backfill = True, stdout = output)
+
+        self.assertEqual(len(output), 2)
+        self.assertTrue(output[0].startswith('testing.TestElement.the_file %s ' % elements[1].pk))
+        self.assertTrue('Files of type application/pdf are not supported.' in output[0])
+        self.assertTrue(output[1].startswith('Audited 2 files: 1 break the rules, 2 sizes backfilled.'))
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+        sizes = dict(TestElement.objects.values_list('pk', 'the_file_size'))
+        self.assertEqual(sizes[elements[0].pk], None)
+        self.assertEqual(sizes[elements[1].pk], elements[1].the_file.size)
+        self.assertEqual(sizes[elements[2].pk], elements[2].the_file.size)
+
+        for element in elements:
+            element.the_file.delete()
+            element.delete()
+        container.delete()
+
+
+    def test_upload_views(self):
+        response = self.client.post('/upload/', {'the_file': self._get_sample_file('image2k.png')})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/upload/', {'the_file': self._get_sample_file('document1k.pdf')})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/upload/no-validate/', {'the_file': self._get_sample_file('document1k.pdf')})
+        self.assertEqual(response.status_code, 201)
+
+        container = self._create_container(name = 'container1')
+        response = self.client.post('/upload/element/%s/' % container.pk,
+                                    {'the_file': self._get_sample_file('image15k.png')})
+        self.assertEqual(response.status_code, 400)
+
+        for instance in list(TestModel.objects.all()) + list(TestModelNoValidate.objects.all()):
+            instance.the_file.delete()
+            instance.delete()
+        container.delete()
+
+
+    def test_upload_view_checked_early(self):
+        response = self.client.post('/upload/checked-early/', {'the_file': self._get_sample_file('document1k.pdf')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Files of type application/pdf are not supported.')
+        response = self.client.post('/upload/checked-early/', {'the_file': self._get_sample_file('image15k.png')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(TestModel.objects.count(), 0)
+
+        response = self.client.post('/upload/checked-early/', {'the_file': self._get_sample_file('image2k.png')})
+        self.assertEqual(response.status_code, 201)
+        instance = TestModel.objects.get()
+        self.assertEqual(instance.the_file.size, 2120)
+        instance.the_file.delete()
+        instance.delete()
+
+
+    def test_upload_view_checked_early_abort(self):
+        response = self.client.post('/upload/checked-early/abort/',
+                                    {'the_file': self._get_sample_file('document1k.pdf')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Files of type application/pdf are not supported.')
+        self.assertEqual(TestModel.objects.count(), 0)
+
+        response = self.client.post('/upload/checked-early/abort/',
+                                    {'the_file': self._get_sample_file('image2k.png')})
+        self.assertEqual(response.status_code, 201)
+        instance = TestModel.objects.get()
+        instance.the_file.delete()
+        instance.delete()
+
+
     def test_form_quota_check(self):
         container = self._create_container(name = 'container1')
 
@@ -307,6 +1531,43 @@ class ValidatedFileFieldTest(TestCase):
         return form
 
 
+    def _create_jpeg(self, height, width, app_length):
+        app1 = b'\xff\xe1' + struct.pack('>H', app_length + 2) + b'\x00' * app_length
+        sof0 = b'\xff\xc0\x00\x11\x08' + struct.pack('>HH', height, width) + b'\x03' + b'\x00' * 9
+        return b'\xff\xd8' + app1 + sof0 + b'\xff\xd9'
+
+
+    def _create_zip_file(self, members):
+        content = io.BytesIO()
+        archive = zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED)
+        for name, filename in members:
+            archive.writestr(name, self._get_sample_file(filename).read())
+        archive.close()
+        return SimpleUploadedFile(name = 'the_file.zip', content = content.getvalue())
+
+
+    def _assert_archive_error(self, field, uploaded_file, message):
+        try:
+            field.validate_file(uploaded_file)
+            self.fail("The archive was accepted")
+        except ValidationError as e:
+            self.assertEqual(e.messages, [message])
+
+
+    def _create_uploaded_file(self, filename):
+        return SimpleUploadedFile(
+                name = filename,
+                content = self._get_sample_file(filename).read(),
+            )
+
+
+    def _create_upload_handler(self, abort = False):
+        return ValidatedFileUploadHandler(
+                fields = {'the_file': TestModel._meta.get_field('the_file')},
+                abort = abort,
+            )
+
+
     def _create_container(self, name):
         return TestContainer.objects.create(name = name)
 
@@ -2,5 +2,9 @@
 from django.conf.urls.defaults import patterns, url, include
 
 urlpatterns = patterns('',
+    url(r'^upload/no-validate/$', 'testing.views.upload_no_validate'),
+    url(r'^upload/$', 'testing.views.upload'),
+    url(r'^upload/checked-early/$', 'testing.views.upload_checked_early'),
+    url(r'^upload/checked-early/abort/$', 'testing.views.upload_checked_early_abort'),
+    url(r'^upload/element/(?P<container_id>\d+)/$', 'testing.views.upload_element'),
 )
-
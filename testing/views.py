@@ -0,0 +1,49 @@
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+
+from testing.forms import TestModelForm, TestModelNoValidateForm, TestElementForm
+from testing.models import TestContainer, TestModel
+from validatedfile.handlers import ValidatedFileUploadHandler
+
+
+def _save_form(form):
+    if not form.is_valid():
+        return HttpResponseBadRequest(' '.join([message for messages in form.errors.values()
+                                                for message in messages]))
+    form.save()
+    return HttpResponse('saved', status=201)
+
+
+def upload_no_validate(request):
+    return _save_form(TestModelNoValidateForm(request.POST, request.FILES))
+
+
+def upload(request):
+    return _save_form(TestModelForm(request.POST, request.FILES))
+
+
+def upload_checked_early(request):
+    request.upload_handlers.insert(0, ValidatedFileUploadHandler(
+            request,
+            fields={'the_file': TestModel._meta.get_field('the_file')},
+        ))
+    return _save_form(TestModelForm(request.POST, request.FILES))
+
+
+def upload_checked_early_abort(request):
+    request.upload_handlers.insert(0, ValidatedFileUploadHandler(
+            request,
+            fields={'the_file': TestModel._meta.get_field('the_file')},
+            abort=True,
+        ))
+    form = TestModelForm(request.POST, request.FILES)
+    # A stopped upload leaves no file in request.FILES for the form to reject
+    if request.rejected_uploads:
+        return HttpResponseBadRequest(' '.join([message for messages in request.rejected_uploads.values()
+                                                for message in messages]))
+    return _save_form(form)
+
+
+def upload_element(request, container_id):
+    container = get_object_or_404(TestContainer, pk=container_id)
+    return _save_form(TestElementForm(container, request.POST, request.FILES))
@@ -0,0 +1,231 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+class LRUCache(object):
+    """
+    Process-local cache that evicts the least recently used entry once it
+    holds max_size entries.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                del self.items[next(iter(self.items))]
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class DjangoCache(object):
+    """
+    Adapter over one of the project's CACHES, so detection results are
+    shared by every process using it.
+    """
+
+    def __init__(self, alias='default', timeout=None):
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout is None and self.timeout or timeout)
+
+    def add(self, key, value):
+        return self.cache.add(key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class SQLiteCache(object):
+    """
+    Cache kept in a local SQLite file, so every worker process of the
+    server on the same host shares its entries. Entries expire timeout
+    seconds after they are set, and the expired ones are purged every
+    purge_interval sets.
+    """
+    purge_interval = 100
+
+    def __init__(self, path, timeout=300):
+        self.path = path
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def connection(self):
+        # SQLite connections may not be shared by threads, nor survive a fork
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS validatedfile_cache '
+                               '(key TEXT PRIMARY KEY, value, expires REAL)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM validatedfile_cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = timeout is not None and time.time() + timeout or None
+        connection = self.connection()
+        connection.execute('INSERT OR REPLACE INTO validatedfile_cache (key, value, expires) VALUES (?, ?, ?)',
+                           (key, value, expires))
+        self.sets += 1
+        if self.sets % self.purge_interval == 0:
+            connection.execute('DELETE FROM validatedfile_cache WHERE expires <= ?', (time.time(),))
+
+    def add(self, key, value):
+        # Sets the entry only if there is no live one: an expired entry is
+        # dropped first, and one written in between is kept by the insert
+        now = time.time()
+        expires = self.timeout is not None and now + self.timeout or None
+        connection = self.connection()
+        connection.execute('DELETE FROM validatedfile_cache WHERE key = ? AND expires <= ?', (key, now))
+        cursor = connection.execute('INSERT OR IGNORE INTO validatedfile_cache (key, value, expires) '
+                                    'VALUES (?, ?, ?)', (key, value, expires))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM validatedfile_cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self.connection().execute('DELETE FROM validatedfile_cache')
+
+
+def detection_key(buffer):
+    return 'validatedfile:%s:%d' % (hashlib.sha1(buffer).hexdigest(), len(buffer))
+
+
+def usage_key(owner_model, owner_id):
+    opts = owner_model._meta
+    return 'validatedfile:usage:%s.%s:%s' % (opts.app_label, opts.object_name, owner_id)
+
+
+def create_cache(setting_name):
+    """
+    Builds the cache configured in the given setting, a dict like
+
+        {'BACKEND': 'memory', 'MAX_SIZE': 1024}
+        {'BACKEND': 'django', 'ALIAS': 'default', 'TIMEOUT': 3600}
+        {'BACKEND': 'sqlite', 'PATH': '/tmp/validatedfile.sqlite3', 'TIMEOUT': 300}
+
+    or returns None if the setting is not given.
+    """
+    options = getattr(settings, setting_name, None)
+    if not options:
+        return None
+    backend = options.get('BACKEND', 'memory')
+    if backend == 'memory':
+        return LRUCache(options.get('MAX_SIZE', 1024))
+    elif backend == 'django':
+        return DjangoCache(options.get('ALIAS', 'default'), options.get('TIMEOUT'))
+    elif backend == 'sqlite':
+        return SQLiteCache(options['PATH'], options.get('TIMEOUT', 300))
+    raise ValueError("Unknown %s backend: %s" % (setting_name, backend))
+
+
+_detection_cache = None
+_usage_cache = None
+
+
+def get_detection_cache():
+    """
+    Returns the cache configured in VALIDATEDFILE_DETECTION_CACHE, or None if
+    detection results are not cached.
+    """
+    global _detection_cache
+    if _detection_cache is None:
+        _detection_cache = create_cache('VALIDATEDFILE_DETECTION_CACHE')
+    return _detection_cache
+
+
+def reset_detection_cache():
+    global _detection_cache
+    _detection_cache = None
+
+
+def get_usage_cache():
+    """
+    Returns the cache configured in VALIDATEDFILE_USAGE_CACHE, or None if the
+    per-owner usage totals are read from the database every time. Totals
+    change with the uploads of every worker, so the cache must be shared by
+    all of them: the 'memory' backend is refused.
+    """
+    global _usage_cache
+    if _usage_cache is None:
+        _usage_cache = create_cache('VALIDATEDFILE_USAGE_CACHE')
+        if isinstance(_usage_cache, LRUCache):
+            _usage_cache = None
+            raise ValueError("VALIDATEDFILE_USAGE_CACHE must be shared by the server processes; "
+                             "use the 'django' or 'sqlite' backend")
+    return _usage_cache
+
+
+def reset_usage_cache():
+    global _usage_cache
+    _usage_cache = None
@@ -0,0 +1,154 @@
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+
+from django import forms
+from django.conf import settings
+from django.db import connections
+from django.db.models import get_model
+from django.utils.importlib import import_module
+from django.utils.translation import ugettext as _
+
+from validatedfile.signals import file_validated
+from validatedfile.workers import logged_callback, logger
+
+PENDING = 'pending'
+ACCEPTED = 'accepted'
+QUARANTINED = 'quarantined'
+
+STATUS_CHOICES = (
+    (PENDING, 'Pending'),
+    (ACCEPTED, 'Accepted'),
+    (QUARANTINED, 'Quarantined'),
+)
+
+# Seconds to wait before storing a result again when the saved row is not
+# visible yet, or no longer has the file
+RETRY_DELAYS = (0.5, 2, 10, 30)
+
+RUNNERS = {
+    'sync': 'validatedfile.deferred.SyncRunner',
+    'thread': 'validatedfile.deferred.ThreadRunner',
+    'process': 'validatedfile.deferred.ProcessRunner',
+}
+
+
+class SyncRunner(object):
+    """
+    Runs the deferred checks right away, in the saving thread.
+    """
+
+    def submit(self, function, args, callback):
+        callback(function(*args))
+
+
+class ThreadRunner(object):
+
+    def __init__(self, workers=2):
+        self.pool = ThreadPool(workers)
+
+    def submit(self, function, args, callback):
+        self.pool.apply_async(function, args, {}, callback)
+
+
+class ProcessRunner(object):
+    """
+    Runs the deferred checks in a pool of worker processes. Only the file is
+    read there; the status is saved and the signal sent in this process.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.pool = None
+        self.pid = None
+
+    def submit(self, function, args, callback):
+        if self.pid != os.getpid():
+            self.pool = Pool(self.workers)
+            self.pid = os.getpid()
+        self.pool.apply_async(function, args, {}, callback)
+
+
+_runner = None
+
+
+def get_runner():
+    """
+    Returns the runner named in the VALIDATEDFILE_DEFERRED_RUNNER setting,
+    one of 'sync', 'thread' (the default) or 'process', or the dotted path
+    of a class with the same interface. VALIDATEDFILE_DEFERRED_WORKERS sizes
+    the pools.
+    """
+    global _runner
+    if _runner is None:
+        name = getattr(settings, 'VALIDATEDFILE_DEFERRED_RUNNER', 'thread')
+        module_name, class_name = RUNNERS.get(name, name).rsplit('.', 1)
+        runner_class = getattr(import_module(module_name), class_name)
+        if runner_class is SyncRunner:
+            _runner = runner_class()
+        else:
+            _runner = runner_class(getattr(settings, 'VALIDATEDFILE_DEFERRED_WORKERS', 2))
+    return _runner
+
+
+def reset_runner():
+    global _runner
+    _runner = None
+
+
+def schedule(model, pk, field_name, file_name):
+    opts = model._meta
+    get_runner().submit(
+        run_deep_validation,
+        (opts.app_label, opts.object_name, field_name, file_name),
+        logged_callback(lambda errors: finish_deep_validation(model, pk, field_name, file_name, errors)),
+    )
+
+
+def run_deep_validation(app_label, model_name, field_name, file_name):
+    # May run in another process, so it only gets picklable arguments and
+    # returns the error messages. It must always return: the pools do not
+    # call back for tasks that raise, and the row would stay pending.
+    try:
+        field = get_model(app_label, model_name)._meta.get_field(field_name)
+        file = field.storage.open(file_name, 'rb')
+    except EnvironmentError:
+        return [_('The file could not be read.')]
+    except Exception:
+        logger.exception("Deep validation of %s could not start", file_name)
+        return [_('The file could not be checked.')]
+    try:
+        field.deep_pipeline.run(field, file)
+    except forms.ValidationError as e:
+        return e.messages
+    except Exception:
+        logger.exception("Deep validation of %s failed", file_name)
+        return [_('The file could not be checked.')]
+    finally:
+        file.close()
+    return []
+
+
+def finish_deep_validation(model, pk, field_name, file_name, errors, attempt=0):
+    field = model._meta.get_field(field_name)
+    status = errors and QUARANTINED or ACCEPTED
+    manager = model._default_manager
+    try:
+        # The file may have been replaced while it was being checked
+        updated = manager.filter(pk=pk, **{field.attname: file_name}).update(**{field.status_field: status})
+    finally:
+        if attempt:
+            # Retries run in threads of their own, each with its connection
+            connections[manager.db].close()
+    if not updated and attempt < len(RETRY_DELAYS):
+        # Or the transaction that saved it is not committed yet, and other
+        # connections do not see the row
+        retry = logged_callback(lambda errors: finish_deep_validation(model, pk, field_name, file_name,
+                                                                      errors, attempt + 1))
+        timer = threading.Timer(RETRY_DELAYS[attempt], retry, (errors,))
+        timer.daemon = True
+        timer.start()
+    elif updated:
+        file_validated.send(sender=model, pk=pk, field_name=field_name, file_name=file_name,
+                            status=status, errors=errors)
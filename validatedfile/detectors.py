@@ -0,0 +1,90 @@
+import os
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from validatedfile.signatures import match_signature
+
+
+class DetectorPool(object):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.reset()
+
+    def get(self):
+        # Detectors are bound to the thread and process that created them;
+        # after a fork the child must not share the parent's libmagic cookie.
+        if self._pid != os.getpid():
+            self.reset()
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = self.factory()
+            self._local.detector = detector
+        return detector
+
+    def reset(self):
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+
+def create_magic_detector():
+    import magic
+
+    # magic_file_path used only for Windows.
+    magic_file_path = getattr(settings, "MAGIC_FILE_PATH", None)
+    if magic_file_path and os.name == 'nt':
+        return magic.Magic(mime=True, magic_file=magic_file_path)
+    return magic.Magic(mime=True)
+
+
+detector_pool = DetectorPool(create_magic_detector)
+
+
+def libmagic_detector(buffer):
+    return detector_pool.get().from_buffer(buffer)
+
+
+def signature_detector(buffer):
+    # Without libmagic, what the table does not know is only a stream of bytes
+    return match_signature(buffer) or 'application/octet-stream'
+
+
+_detectors = {
+    'libmagic': libmagic_detector,
+    'signatures': signature_detector,
+}
+_detector = None
+
+
+def register_detector(name, detector):
+    _detectors[name] = detector
+
+
+def get_detector():
+    """
+    Returns the callable that tells the content type of the leading bytes of
+    a file, chosen with the VALIDATEDFILE_DETECTOR setting: a name given to
+    register_detector ('libmagic', the default, or 'signatures'), the dotted
+    path of a callable, or the callable itself. It is loaded on first use,
+    so importing the app does not load libmagic.
+    """
+    global _detector
+    if _detector is None:
+        detector = getattr(settings, 'VALIDATEDFILE_DETECTOR', 'libmagic')
+        if not callable(detector):
+            if detector in _detectors:
+                detector = _detectors[detector]
+            elif '.' in detector:
+                module_name, function_name = detector.rsplit('.', 1)
+                detector = getattr(import_module(module_name), function_name)
+            else:
+                raise ValueError("Unknown VALIDATEDFILE_DETECTOR: %s" % detector)
+        _detector = detector
+    return _detector
+
+
+def reset_detector():
+    global _detector
+    _detector = None
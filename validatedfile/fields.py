@@ -1,55 +1,426 @@
 from django.db import models
+from django.db.models import signals, Sum
+from django.db.models.fields.files import FieldFile, FileDescriptor
+from django.core.files import File
 from django import forms
 from django.template.defaultfilters import filesizeformat
+from django.utils import translation
 from django.utils.translation import ugettext as _
 from django.conf import settings
-import os
+from functools import partial
+import copy
 
-import magic
+from validatedfile import deferred, metrics
+from validatedfile.cache import detection_key, get_detection_cache
+from validatedfile.detectors import detector_pool, get_detector
+from validatedfile.models import FileUsage, QuotaReservation
+from validatedfile.policies import ContentTypePolicy
+from validatedfile.signatures import match_signature, sniff_length
+from validatedfile.sniffing import peek
+from validatedfile.storage import StoredFile
+from validatedfile.stages import ArchiveStage, ContentTypeStage, DigestStage, ImageDimensionsStage, \
+                                 MaxSizeStage, ValidationPipeline
+from validatedfile.workers import background_pool, logged_callback, thread_pools
+
+
+def magic_from_buffer(buffer):
+    cache = get_detection_cache()
+    if cache is None:
+        return get_detector()(buffer)
+
+    key = detection_key(buffer)
+    content_type = cache.get(key)
+    if content_type is None:
+        content_type = get_detector()(buffer)
+        cache.set(key, content_type)
+    return content_type
+
+
+def stored_file_name(value):
+    # Only names loaded from the database or already committed to storage
+    # count towards the usage; pending uploads are counted on save.
+    if isinstance(value, FieldFile):
+        return value._committed and value.name or None
+    if isinstance(value, File):
+        return None
+    return value or None
+
+
+class ValidatedFieldFile(FieldFile):
+
+    def delete(self, save=True):
+        # Remember the size while the file still exists in storage, so the
+        # usage of the quota owner can be decreased when the instance is saved.
+        if self.name and self.field.quota_owner:
+            self.instance.__dict__[self.field._deleted_size_key] = self.field.initial_size(self.instance, self.name)
+        super(ValidatedFieldFile, self).delete(save)
+
+
+class ValidatedFileDescriptor(FileDescriptor):
+
+    def __set__(self, instance, value):
+        super(ValidatedFileDescriptor, self).__set__(instance, value)
+        if self.field.size_field:
+            self.field.update_size_field(instance, value)
+        if self.field.status_field:
+            self.field.update_status_field(instance, value)
 
 
 class ValidatedFileField(models.FileField):
+    attr_class = ValidatedFieldFile
+    descriptor_class = ValidatedFileDescriptor
+
     def __init__(self, *args, **kwargs):
         self.content_types = kwargs.pop("content_types", [])
+        self.check_extension = kwargs.pop("check_extension", False)
+        self.content_type_policy = ContentTypePolicy(self.content_types, self.check_extension)
         self.max_upload_size = kwargs.pop("max_upload_size", 0)
         self.mime_lookup_length = kwargs.pop("mime_lookup_length", 4096)
+        self.quota_owner = kwargs.pop("quota_owner", None)
+        self.size_field = kwargs.pop("size_field", None)
+        self.digest_field = kwargs.pop("digest_field", None)
+        self.digest_algorithm = kwargs.pop("digest_algorithm", "sha256")
+        self.max_dimensions = kwargs.pop("max_dimensions", None)
+        self.max_pixels = kwargs.pop("max_pixels", None)
+        self.archive_member_types = kwargs.pop("archive_member_types", [])
+        self.archive_max_members = kwargs.pop("archive_max_members", None)
+        self.archive_max_size = kwargs.pop("archive_max_size", None)
+        self.archive_max_ratio = kwargs.pop("archive_max_ratio", None)
+        self.status_field = kwargs.pop("status_field", None)
+        self.deep_pipeline = ValidationPipeline(kwargs.pop("deep_stages", []))
+        self.sniff_length = sniff_length(self.content_type_policy.listed_types(), self.mime_lookup_length)
+        self.pipeline = ValidationPipeline(self.default_stages() + list(kwargs.pop("stages", [])))
         super(ValidatedFileField, self).__init__(*args, **kwargs)
 
-    def clean(self, *args, **kwargs):
-        data = super(ValidatedFileField, self).clean(*args, **kwargs)
-        file = data.file
-
+    def default_stages(self):
+        stages = []
+        if self.digest_field:
+            stages.append(DigestStage())
         if self.content_types:
-            uploaded_content_type = getattr(file, 'content_type', '')
-            
-            # magic_file_path used only for Windows.
-            magic_file_path = getattr(settings, "MAGIC_FILE_PATH", None)
-            if magic_file_path and os.name == 'nt':
-                mg = magic.Magic(mime=True, magic_file=magic_file_path)
+            stages.append(ContentTypeStage())
+        if self.max_upload_size:
+            stages.append(MaxSizeStage())
+        if self.max_dimensions or self.max_pixels:
+            stages.append(ImageDimensionsStage(self.max_dimensions, self.max_pixels))
+        if self.archive_member_types or self.archive_max_members or self.archive_max_size or \
+                self.archive_max_ratio:
+            stages.append(ArchiveStage(self.archive_member_types, self.archive_max_members,
+                                       self.archive_max_size, self.archive_max_ratio))
+        return stages
+
+    def contribute_to_class(self, cls, name):
+        super(ValidatedFileField, self).contribute_to_class(cls, name)
+        self._usage_state_key = '_%s_usage_state' % name
+        self._usage_changes_key = '_%s_usage_changes' % name
+        self._deleted_size_key = '_%s_deleted_size' % name
+        self._deep_validation_key = '_%s_deep_validation' % name
+        if self.quota_owner and not cls._meta.abstract:
+            signals.post_init.connect(self.remember_usage_state, sender=cls)
+            signals.post_save.connect(self.save_usage_changes, sender=cls)
+            signals.post_delete.connect(self.remove_usage, sender=cls)
+        if (self.size_field or self.status_field) and not cls._meta.abstract:
+            signals.post_init.connect(self.update_dependent_fields, sender=cls)
+        if self.deep_pipeline.stages and not cls._meta.abstract:
+            signals.post_save.connect(self.schedule_deep_validation, sender=cls)
+
+    def pre_save(self, model_instance, add):
+        file = getattr(model_instance, self.attname)
+        committing = bool(file) and not file._committed
+        # Left by QuotaValidator.reserve_for while the upload was validated
+        reservation = committing and getattr(file.file, 'quota_reservation', None) or None
+        if self.digest_field and committing:
+            # Computed before the file is stored, so storages can use it too
+            file.content_digest = self.content_digest(file.file)
+            setattr(model_instance, self.digest_field, file.content_digest)
+        if self.size_field and committing:
+            # Read while the upload is at hand, instead of asking the storage
+            size = file.size
+        file = super(ValidatedFileField, self).pre_save(model_instance, add)
+        if self.size_field and committing:
+            setattr(model_instance, self.size_field, size)
+        elif self.size_field and not file:
+            setattr(model_instance, self.size_field, None)
+        if self.digest_field and not file:
+            setattr(model_instance, self.digest_field, None)
+        if self.status_field and committing:
+            setattr(model_instance, self.status_field, self.initial_status())
+        elif self.status_field and not file:
+            setattr(model_instance, self.status_field, None)
+        if self.deep_pipeline.stages and committing:
+            model_instance.__dict__[self._deep_validation_key] = True
+        if self.quota_owner:
+            self.track_usage_changes(model_instance, file, reservation)
+        return file
+
+    def clean(self, value, model_instance):
+        data = super(ValidatedFileField, self).clean(value, model_instance)
+        if getattr(data, '_committed', False):
+            # Already in the storage: only the byte ranges the checks need are
+            # read, instead of fetching the whole file.
+            file = StoredFile(self.storage, data.name)
+            if self.digest_field:
+                file.content_digest = getattr(model_instance, self.digest_field) or None
+        else:
+            file = data.file
+        try:
+            self.validate_file(file)
+        except forms.ValidationError:
+            # The room reserved by QuotaValidator.reserve_for is not needed
+            reservation = getattr(file, 'quota_reservation', None)
+            if reservation is not None:
+                FileUsage.objects.release_reservation(reservation)
+                file.quota_reservation = None
+            raise
+        finally:
+            if isinstance(file, StoredFile):
+                file.close()
+        if self.digest_field:
+            setattr(model_instance, self.digest_field, file.content_digest)
+        return data
+
+    def validate_file(self, file):
+        upload_errors = getattr(file, 'upload_errors', None)
+        if upload_errors:
+            # Dropped by ValidatedFileUploadHandler while it was arriving
+            raise forms.ValidationError(upload_errors)
+        self.pipeline.run(self, file)
+
+    def validate_many(self, files, workers=4, quota_validator=None):
+        """
+        Validates several uploads in a pool of threads and returns, in the
+        same order, the ValidationError of each file or None if it is valid.
+        If a QuotaValidator is given, the valid files are checked against the
+        quota as a whole, and all of them get its error if they exceed it.
+        """
+        files = list(files)
+        if workers > 1 and len(files) > 1:
+            # Worker threads do not inherit the active language of the caller
+            validation_error = partial(self.validation_error, language=translation.get_language())
+            errors = thread_pools.get(workers).map(validation_error, files)
+        else:
+            errors = [self.validation_error(file) for file in files]
+
+        if quota_validator is not None:
+            total_size = sum([file.size for file, error in zip(files, errors) if error is None])
+            try:
+                quota_validator.check_total(total_size)
+            except forms.ValidationError as e:
+                errors = [error or e for error in errors]
+        return errors
+
+    def validate_file_async(self, file, callback=None):
+        """
+        Runs validate_file in the background pool without blocking the caller.
+        Returns an AsyncResult whose value is the ValidationError of the file
+        or None; callback, if given, is called with that value.
+        """
+        return background_pool().apply_async(self.validation_error, (file,),
+                                             {'language': translation.get_language()}, logged_callback(callback))
+
+    def validation_error(self, file, language=None):
+        if language:
+            translation.activate(language)
+        try:
+            self.validate_file(file)
+        except forms.ValidationError as e:
+            return e
+        return None
+
+    def audit_stored_file(self, name):
+        """
+        Checks the type and size of a file already in the storage against the
+        current rules, reading only the leading bytes the type detection
+        needs. Returns the stored size (None if the file is missing) and the
+        messages of the rules it breaks.
+        """
+        file = StoredFile(self.storage, name)
+        messages = []
+        try:
+            if self.content_types:
+                try:
+                    self.check_content_type(self.sniff_content_type(file), name)
+                except forms.ValidationError as e:
+                    messages.extend(e.messages)
+            size = file.size
+        except EnvironmentError:
+            return None, [_('The file could not be read.')]
+        finally:
+            file.close()
+
+        try:
+            self.check_size(size)
+        except forms.ValidationError as e:
+            messages.extend(e.messages)
+        return size, messages
+
+    def update_dependent_fields(self, instance, **kwargs):
+        # Model.__init__ sets the fields declared after this one once the
+        # descriptor has filled them, so an upload given to the constructor
+        # fills them again, as ImageField does with its dimensions.
+        value = instance.__dict__.get(self.attname)
+        if isinstance(value, File) and not getattr(value, '_committed', False):
+            if self.size_field:
+                self.update_size_field(instance, value)
+            if self.status_field:
+                self.update_status_field(instance, value)
+
+    def update_size_field(self, instance, value):
+        # Only uploads carry a size that is known without asking the storage;
+        # names loaded from the database keep the stored size.
+        if not value:
+            setattr(instance, self.size_field, None)
+        elif isinstance(value, File) and not getattr(value, '_committed', False):
+            setattr(instance, self.size_field, value.size)
+
+    def update_status_field(self, instance, value):
+        if not value:
+            setattr(instance, self.status_field, None)
+        elif isinstance(value, File) and not getattr(value, '_committed', False):
+            setattr(instance, self.status_field, self.initial_status())
+
+    def initial_status(self):
+        return self.deep_pipeline.stages and deferred.PENDING or deferred.ACCEPTED
+
+    def schedule_deep_validation(self, instance, **kwargs):
+        if instance.__dict__.pop(self._deep_validation_key, False):
+            deferred.schedule(type(instance), instance.pk, self.name, getattr(instance, self.attname).name)
+
+    def quota_owner_field(self):
+        return self.model._meta.get_field(self.quota_owner)
+
+    def stored_size(self, name):
+        metrics.get_collector().count('storage_size_calls')
+        try:
+            return self.storage.size(name)
+        except (AttributeError, EnvironmentError):
+            return 0  # Protect against the inconsistence of that the file
+                      # has been deleted in storage but still is in the field
+
+    def initial_size(self, instance, name):
+        owner_id, initial_name, size = instance.__dict__.get(self._usage_state_key, (None, None, None))
+        if name != initial_name or size is None:
+            size = self.stored_size(name)
+        return size
+
+    def usage_state(self, instance):
+        owner_id = getattr(instance, self.quota_owner_field().attname)
+        size = self.size_field and getattr(instance, self.size_field) or None
+        return owner_id, stored_file_name(instance.__dict__.get(self.attname)), size
+
+    def remember_usage_state(self, instance, **kwargs):
+        instance.__dict__[self._usage_state_key] = self.usage_state(instance)
+
+    def track_usage_changes(self, instance, file, reservation=None):
+        old_owner_id, old_name, old_size = instance.__dict__.get(self._usage_state_key, (None, None, None))
+        new_owner_id, new_name, new_size = self.usage_state(instance)
+        if (old_owner_id, old_name) == (new_owner_id, new_name):
+            return
+
+        changes = []
+        old_size = instance.__dict__.pop(self._deleted_size_key, old_size)
+        if old_name and old_owner_id is not None:
+            if old_size is None:
+                old_size = self.stored_size(old_name)
+            changes.append((old_owner_id, -old_size))
+        if new_name and new_owner_id is not None:
+            if reservation is not None and reservation.object_id == new_owner_id:
+                changes.append((new_owner_id, reservation))
+            elif new_name == old_name and old_size is not None:
+                changes.append((new_owner_id, old_size))
+            elif new_size is not None:
+                changes.append((new_owner_id, new_size))
             else:
-                mg = magic.Magic(mime=True)
-            content_type_magic = mg.from_buffer(
-                file.read(self.mime_lookup_length)
-            )
-            file.seek(0)
+                try:
+                    changes.append((new_owner_id, file.size))
+                except (AttributeError, EnvironmentError):
+                    pass
+        instance.__dict__[self._usage_changes_key] = changes
+        instance.__dict__[self._usage_state_key] = (new_owner_id, new_name, new_size)
 
-            # Prefere mime-type instead mime-type from http header
-            if uploaded_content_type != content_type_magic:
-                uploaded_content_type = content_type_magic
+    def save_usage_changes(self, instance, **kwargs):
+        owner_model = self.quota_owner_field().rel.to
+        for owner_id, delta in instance.__dict__.pop(self._usage_changes_key, []):
+            if isinstance(delta, QuotaReservation):
+                # Unless it expired and was released in the meantime
+                if FileUsage.objects.commit_reservation(delta):
+                    continue
+                delta = delta.size
+            FileUsage.objects.add_usage(owner_model, owner_id, delta)
 
-            if not uploaded_content_type in self.content_types:
-                raise forms.ValidationError(
-                    _('Files of type %(type)s are not supported.') % {'type': content_type_magic}
-                )
+    def remove_usage(self, instance, **kwargs):
+        owner_id, name, size = instance.__dict__.pop(self._usage_state_key, (None, None, None))
+        if name and owner_id is not None:
+            if size is None:
+                size = self.stored_size(name)
+            FileUsage.objects.add_usage(self.quota_owner_field().rel.to, owner_id, -size)
 
-        if self.max_upload_size and hasattr(file, '_size'):
-            if file._size > self.max_upload_size:
-                raise forms.ValidationError(
-                    _('Files of size greater than %(max_size)s are not allowed. Your file is %(current_size)s') %
-                    {'max_size': filesizeformat(self.max_upload_size), 'current_size': filesizeformat(file._size)}
-                )
+    def content_digest(self, file):
+        if getattr(file, 'content_digest', None) is None:
+            ValidationPipeline([DigestStage()]).run(self, file)
+        return file.content_digest
 
-        return data
+    def sniff_content_type(self, file, prefix=None, peeked=None):
+        if peeked is not None:
+            # Shared with the other stages that peek at the file
+            read = peeked.read
+        elif prefix is None:
+            read = lambda length: peek(file, length)
+        else:
+            # The leading bytes were already read in the pass shared with
+            # the other validation stages
+            read = lambda length: prefix[:length]
+
+        with metrics.timer('read'):
+            buffer = read(self.sniff_length)
+        with metrics.timer('detect'):
+            content_type = match_signature(buffer)
+        if content_type is None:
+            # The allowed types could not tell it apart; widen the read to
+            # what libmagic needs.
+            if len(buffer) == self.sniff_length < self.mime_lookup_length:
+                with metrics.timer('read'):
+                    buffer = read(self.mime_lookup_length)
+            with metrics.timer('detect'):
+                content_type = magic_from_buffer(buffer)
+
+        collector = metrics.get_collector()
+        if collector.enabled:
+            collector.count('bytes_read', len(buffer))
+            collector.event('content_type', content_type)
+        return content_type
+
+    def detect_content_type(self, buffer):
+        with metrics.timer('detect'):
+            # The signature table decides the common types from a few bytes;
+            # libmagic is only needed when it cannot tell.
+            content_type = match_signature(buffer) or magic_from_buffer(buffer)
+
+        collector = metrics.get_collector()
+        if collector.enabled:
+            collector.event('content_type', content_type)
+        return content_type
+
+    def check_content_type(self, content_type, name=None):
+        if not content_type in self.content_type_policy:
+            metrics.get_collector().event('rejected', 'content_type')
+            raise forms.ValidationError(
+                _('Files of type %(type)s are not supported.') % {'type': content_type}
+            )
+        if not self.content_type_policy.extension_matches(name, content_type):
+            metrics.get_collector().event('rejected', 'extension')
+            raise forms.ValidationError(
+                _('The extension of the file does not match its type %(type)s.') % {'type': content_type}
+            )
+
+    def check_size(self, size):
+        with metrics.timer('size_check'):
+            exceeded = self.max_upload_size and size > self.max_upload_size
+        if exceeded:
+            metrics.get_collector().event('rejected', 'size')
+            raise forms.ValidationError(
+                _('Files of size greater than %(max_size)s are not allowed. Your file is %(current_size)s') %
+                {'max_size': filesizeformat(self.max_upload_size), 'current_size': filesizeformat(size)}
+            )
 
 
 class FileQuota(object):
@@ -58,17 +429,82 @@ class FileQuota(object):
         self.current_usage = 0
         self.max_usage = max_usage
 
+    @classmethod
+    def for_owners(cls, owners, related_name, attr_name, max_usage=-1):
+        """
+        Returns a dict with the FileQuota of every owner in the queryset, by
+        primary key, for the files in attr_name of the items related to them
+        by related_name. The stored sizes of size_field are added up with one
+        grouped query; only the rows without one are asked to the storage.
+        """
+        related = owners.model._meta.get_field_by_name(related_name)[0]
+        items = related.model._default_manager.filter(**{'%s__in' % related.field.name: owners})
+        field = related.model._meta.get_field(attr_name)
+        size_field = field.size_field
+
+        with metrics.timer('quota_update'):
+            quotas = {}
+            if size_field:
+                totals = owners.annotate(file_usage=Sum('%s__%s' % (related_name, size_field))) \
+                               .values_list('pk', 'file_usage')
+                for pk, total in totals.iterator():
+                    quotas[pk] = cls(max_usage)
+                    quotas[pk].current_usage = total or 0
+                items = items.filter(**{'%s__isnull' % size_field: True})
+            else:
+                for pk in owners.values_list('pk', flat=True).iterator():
+                    quotas[pk] = cls(max_usage)
+
+            missing = items.filter(**{'%s__gt' % field.attname: ''}) \
+                           .values_list(related.field.attname, field.attname)
+            for owner_id, name in missing.iterator():
+                quotas[owner_id].current_usage += field.stored_size(name)
+        return quotas
+
     def update(self, items, attr_name):
-        self.current_usage = 0
+        with metrics.timer('quota_update'):
+            self.current_usage = 0
+            self.add_file_sizes(items, attr_name)
+
+    def update_from_queryset(self, items, attr_name, distinct=False):
+        field = items.model._meta.get_field(attr_name)
+        size_field = field.size_field
+        if not size_field:
+            return self.update(items, attr_name)
+
+        with metrics.timer('quota_update'):
+            if distinct and field.digest_field:
+                # Files with the same content share one blob in deduplicating
+                # storages, so they are counted once.
+                digest_isnull = '%s__isnull' % field.digest_field
+                sizes = items.filter(**{digest_isnull: False}) \
+                             .values_list(field.digest_field, size_field).distinct()
+                self.current_usage = sum([size or 0 for digest, size in sizes])
+                self.current_usage += items.filter(**{digest_isnull: True}) \
+                                           .aggregate(total=Sum(size_field))['total'] or 0
+            else:
+                self.current_usage = items.aggregate(total=Sum(size_field))['total'] or 0
+            # Rows saved before the size column was added are still summed one
+            # by one until the column is filled in.
+            missing = items.filter(**{'%s__isnull' % size_field: True}).exclude(**{attr_name: ''})
+            self.add_file_sizes(missing, attr_name)
+
+    def add_file_sizes(self, items, attr_name):
+        collector = metrics.get_collector()
         for item in items:
             the_file = getattr(item, attr_name, None)
             if the_file:
+                collector.count('storage_size_calls')
                 try:
                     self.current_usage += the_file.size
                 except AttributeError:
                     pass  # Protect against the inconsistence of that the file
                           # has been deleted in storage but still is in the field
 
+    def update_from_usage(self, owner):
+        with metrics.timer('quota_update'):
+            self.current_usage = FileUsage.objects.get_usage(type(owner), owner.pk)
+
     def exceeds(self, size=0):
         if self.max_usage >= 0:
             return (self.current_usage + size > self.max_usage)
@@ -76,26 +512,91 @@ class FileQuota(object):
             return False
 
     def near_limit(self, limit_threshold=0.8):
-        return (float(self.current_usage) / float(self.max_usage)) > limit_threshold
+        if self.max_usage < 0:
+            return False  # Unlimited
+        return self.current_usage > limit_threshold * self.max_usage
+
+    def percentage(self):
+        """
+        Used part of the quota, from 0 to 100 or more if it is exceeded; None
+        if the quota is unlimited. A zero quota counts as fully used.
+        """
+        if self.max_usage < 0:
+            return None
+        if self.max_usage == 0:
+            return 100.0
+        return 100.0 * self.current_usage / self.max_usage
 
 
 class QuotaValidator(object):
 
     def __init__(self, max_usage):
         self.quota = FileQuota(max_usage)
+        self.owner = None
+        self.timeout = None
+
+    def reserve_for(self, owner, timeout=None):
+        """
+        Returns a copy of the validator that reserves the size of every file
+        in the usage of the owner, atomically with the other uploads of the
+        owner, instead of comparing it with a snapshot of the usage. The
+        validators of a form field are shared by all the forms, so the copy
+        must replace the validator in the fields of the form instance.
+
+        The reservation is left in the quota_reservation attribute of the
+        file, and is committed when the file is saved in a field whose
+        quota_owner is the owner. If it never is, release it with
+        FileUsage.objects.release_reservation, or it will be released once
+        it times out.
+        """
+        validator = copy.copy(self)
+        validator.quota = copy.copy(self.quota)
+        validator.owner = owner
+        validator.timeout = timeout
+        return validator
 
     def update_quota(self, items, attr_name):
         self.quota.update(items, attr_name)
 
+    def update_quota_from_usage(self, owner):
+        self.quota.update_from_usage(owner)
+
+    def update_quota_from_queryset(self, items, attr_name, distinct=False):
+        self.quota.update_from_queryset(items, attr_name, distinct)
+
+    def update_quota_async(self, items, attr_name, callback=None):
+        return background_pool().apply_async(self.quota.update, (items, attr_name), {}, logged_callback(callback))
+
+    def update_quota_from_queryset_async(self, items, attr_name, callback=None):
+        return background_pool().apply_async(self.quota.update_from_queryset, (items, attr_name), {},
+                                             logged_callback(callback))
+
     def __call__(self, file):
-        file_size = file.size
-        if self.quota.exceeds(file_size):
-            raise forms.ValidationError(
-                _('Please keep the total uploaded files under %(total_size)s. With this file, the total would be %(exceed_size)s.' %
-                {'total_size': filesizeformat(self.quota.max_usage), 'exceed_size': filesizeformat(self.quota.current_usage + file_size)})
-            )
+        if self.owner is None:
+            self.check_total(file.size)
+        else:
+            self.reserve(file)
+
+    def reserve(self, file):
+        reservation = FileUsage.objects.reserve(type(self.owner), self.owner.pk, file.size,
+                                                self.quota.max_usage, self.timeout)
+        if reservation is None:
+            self.quota.update_from_usage(self.owner)
+            self.reject(file.size)
+        file.quota_reservation = reservation
+
+    def check_total(self, size):
+        if self.quota.exceeds(size):
+            self.reject(size)
+
+    def reject(self, size):
+        metrics.get_collector().event('rejected', 'quota')
+        raise forms.ValidationError(
+            _('Please keep the total uploaded files under %(total_size)s. With this file, the total would be %(exceed_size)s.' %
+            {'total_size': filesizeformat(self.quota.max_usage), 'exceed_size': filesizeformat(self.quota.current_usage + size)})
+        )
 
-try:
+if 'south' in settings.INSTALLED_APPS:
     from south.modelsinspector import add_introspection_rules
     add_introspection_rules([
         (
@@ -103,10 +604,20 @@ try:
             [],
             {
                 "content_types": ["content_types", {"default": []}],
+                "check_extension": ["check_extension", {"default": False}],
                 "max_upload_size": ["max_upload_size", {"default": 0}],
                 "mime_lookup_length": ["mime_lookup_length", {"default": 4096}],
+                "quota_owner": ["quota_owner", {"default": None}],
+                "size_field": ["size_field", {"default": None}],
+                "digest_field": ["digest_field", {"default": None}],
+                "digest_algorithm": ["digest_algorithm", {"default": "sha256"}],
+                "max_dimensions": ["max_dimensions", {"default": None}],
+                "max_pixels": ["max_pixels", {"default": None}],
+                "archive_member_types": ["archive_member_types", {"default": []}],
+                "archive_max_members": ["archive_max_members", {"default": None}],
+                "archive_max_size": ["archive_max_size", {"default": None}],
+                "archive_max_ratio": ["archive_max_ratio", {"default": None}],
+                "status_field": ["status_field", {"default": None}],
             },
         ),
     ], ["^validatedfile\.fields\.ValidatedFileField"])
-except ImportError:
-    pass
@@ -0,0 +1,81 @@
+from io import BytesIO
+
+from django import forms
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+
+class RejectedUpload(UploadedFile):
+    """
+    Empty stand-in left in request.FILES for a file dropped by
+    ValidatedFileUploadHandler. Validating it in a ValidatedFileField raises
+    the messages of the checks it failed, kept in upload_errors, so the form
+    reports them like any other invalid file.
+    """
+
+    def __init__(self, name, content_type, size, charset, upload_errors):
+        super(RejectedUpload, self).__init__(BytesIO(), name, content_type, size, charset)
+        self.upload_errors = upload_errors
+
+
+class ValidatedFileUploadHandler(FileUploadHandler):
+    """
+    Upload handler that applies the content_types and max_upload_size checks
+    of ValidatedFileFields while the upload is still arriving, so a disallowed
+    or oversize file is dropped after the first offending chunk.
+
+    It must be installed before the handlers that store the file. The fields
+    to check are given as a mapping of form field name to model field, either
+    in the constructor or in request.validated_file_fields.
+
+    With abort, the rest of the request is not read and the rejected file is
+    missing from request.FILES, so the view must check
+    request.rejected_uploads itself: a form would not see the file, and on a
+    field that may be blank it would be valid.
+    """
+
+    def __init__(self, request=None, fields=None, abort=False):
+        super(ValidatedFileUploadHandler, self).__init__(request)
+        if fields is None:
+            fields = getattr(request, 'validated_file_fields', {})
+        self.fields = fields
+        self.abort = abort
+        self.errors = {}
+        self.field = None
+        self.rejected = None
+        if request is not None:
+            request.rejected_uploads = self.errors
+
+    def new_file(self, field_name, *args, **kwargs):
+        super(ValidatedFileUploadHandler, self).new_file(field_name, *args, **kwargs)
+        self.field = self.fields.get(field_name)
+        self.rejected = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.rejected is not None:
+            return None  # The rest of a rejected file is not stored
+        if self.field is not None:
+            try:
+                if start == 0 and self.field.content_types:
+                    self.field.check_content_type(
+                        self.field.detect_content_type(raw_data[:self.field.mime_lookup_length]),
+                        self.file_name
+                    )
+                self.field.check_size(start + len(raw_data))
+            except forms.ValidationError as e:
+                self.reject(e)
+                return None
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.rejected is None:
+            return None
+        # Takes the place of the file the next handlers were storing
+        return RejectedUpload(self.file_name, self.content_type, file_size, self.charset, self.rejected)
+
+    def reject(self, error):
+        self.errors[self.field_name] = error.messages
+        self.field = None
+        if self.abort:
+            raise StopUpload(connection_reset=True)
+        self.rejected = error.messages
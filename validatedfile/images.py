@@ -0,0 +1,69 @@
+import struct
+
+# Returned when the buffer starts like a known image format but ends before
+# its dimensions.
+INCOMPLETE = 'incomplete'
+
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | set([0x01])
+
+
+def image_dimensions(buffer):
+    """
+    Returns the (width, height) of a PNG, GIF, WebP or JPEG image read from
+    its header, INCOMPLETE if more bytes are needed, or None if the buffer
+    is not one of those formats.
+    """
+    if buffer.startswith(b'\x89PNG\r\n\x1a\n'):
+        return unpack_dimensions('>II', buffer, 16)
+    if buffer[:6] in (b'GIF87a', b'GIF89a'):
+        return unpack_dimensions('<HH', buffer, 6)
+    if buffer[:4] == b'RIFF' and buffer[8:12] == b'WEBP':
+        return webp_dimensions(buffer)
+    if buffer.startswith(b'\xff\xd8'):
+        return jpeg_dimensions(buffer)
+    return None
+
+
+def unpack_dimensions(format, buffer, offset):
+    end = offset + struct.calcsize(format)
+    if len(buffer) < end:
+        return INCOMPLETE
+    return struct.unpack(format, buffer[offset:end])
+
+
+def webp_dimensions(buffer):
+    if len(buffer) < 30:
+        return INCOMPLETE
+    chunk = buffer[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', buffer[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        b0, b1, b2, b3 = bytearray(buffer[21:25])
+        return (1 + (b0 | (b1 & 0x3f) << 8),
+                1 + (b1 >> 6 | b2 << 2 | (b3 & 0x0f) << 10))
+    if chunk == b'VP8X':
+        w0, w1, w2, h0, h1, h2 = bytearray(buffer[24:30])
+        return 1 + (w0 | w1 << 8 | w2 << 16), 1 + (h0 | h1 << 8 | h2 << 16)
+    return None
+
+
+def jpeg_dimensions(buffer):
+    data = bytearray(buffer)
+    position = 2
+    while True:
+        while position < len(data) and data[position] != 0xFF:
+            position += 1  # Not at a marker, skip garbage
+        while position < len(data) and data[position] == 0xFF:
+            position += 1  # Fill bytes
+        if position + 7 >= len(data):
+            return INCOMPLETE
+        marker = data[position]
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', bytes(data[position + 4:position + 8]))
+            return width, height
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 1
+        else:
+            position += 1 + (data[position + 1] << 8 | data[position + 2])
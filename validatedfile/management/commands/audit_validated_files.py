@@ -0,0 +1,121 @@
+from optparse import make_option
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model, get_models
+
+from validatedfile.fields import ValidatedFileField
+from validatedfile.workers import thread_pools
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = ("Checks the files already stored in the ValidatedFileFields against the current "
+            "content_types and max_upload_size of the fields, and reports the ones that break them.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help="Number of rows read from the database at a time."),
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help="Number of threads checking the files of a batch."),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help="File where the progress is kept, so an interrupted run "
+                         "given the same file resumes where it stopped."),
+        make_option('--backfill', action='store_true', dest='backfill', default=False,
+                    help="Store the size of the files whose size_field is empty."),
+    )
+
+    def handle(self, *labels, **options):
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.backfill = options['backfill']
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = self.load_checkpoint()
+        self.audited = self.failed = self.backfilled = 0
+
+        for model in self.get_models(labels):
+            for field in model._meta.fields:
+                if isinstance(field, ValidatedFileField):
+                    self.audit_field(model, field)
+
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)  # The run is complete
+        self.stdout.write("Audited %d files: %d break the rules, %d sizes backfilled.\n" %
+                          (self.audited, self.failed, self.backfilled))
+
+    def get_models(self, labels):
+        if not labels:
+            return get_models()
+        models = []
+        for label in labels:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError("Models must be given as app_label.ModelName, not %r." % label)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError("Unknown model: %s" % label)
+            models.append(model)
+        return models
+
+    def audit_field(self, model, field):
+        opts = model._meta
+        key = '%s.%s.%s' % (opts.app_label, opts.object_name, field.name)
+        backfill = self.backfill and field.size_field
+        columns = ['pk', field.attname]
+        if backfill:
+            columns.append(field.size_field)
+        # Excludes both the empty and the null names
+        rows = model._default_manager.filter(**{field.attname + '__gt': ''}) \
+                                     .order_by('pk').values_list(*columns)
+
+        last_pk = self.checkpoint.get(key)
+        while True:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            batch = list(batch[:self.batch_size].iterator())
+            if not batch:
+                break
+
+            names = [row[1] for row in batch]
+            if self.workers > 1:
+                results = thread_pools.get(self.workers).map(field.audit_stored_file, names)
+            else:
+                results = [field.audit_stored_file(name) for name in names]
+
+            self.report(key, batch, results)
+            if backfill:
+                self.backfill_sizes(model, field, batch, results)
+
+            last_pk = batch[-1][0]
+            self.save_checkpoint(key, last_pk)
+
+    def report(self, key, batch, results):
+        for row, (size, messages) in zip(batch, results):
+            self.audited += 1
+            if messages:
+                self.failed += 1
+                self.stdout.write("%s %s %s: %s\n" % (key, row[0], row[1], ' '.join(messages)))
+
+    @transaction.commit_on_success
+    def backfill_sizes(self, model, field, batch, results):
+        for row, (size, messages) in zip(batch, results):
+            if row[2] is None and size is not None:
+                model._default_manager.filter(pk=row[0]).update(**{field.size_field: size})
+                self.backfilled += 1
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def save_checkpoint(self, key, last_pk):
+        if not self.checkpoint_path:
+            return
+        self.checkpoint[key] = last_pk
+        # Written aside and renamed, so an interruption never leaves it half written
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.rename(temp_path, self.checkpoint_path)
@@ -0,0 +1,47 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import get_models
+
+from validatedfile.cache import get_usage_cache
+from validatedfile.fields import ValidatedFileField
+from validatedfile.models import FileUsage, QuotaReservation
+
+
+class Command(NoArgsCommand):
+    help = "Recalculates the per-owner usage totals of the ValidatedFileFields with a quota_owner."
+
+    def handle_noargs(self, **options):
+        totals = {}
+        for model in get_models():
+            for field in model._meta.fields:
+                if isinstance(field, ValidatedFileField) and field.quota_owner:
+                    self.add_field_totals(totals, model, field)
+
+        self.save_totals(totals)
+        self.stdout.write("Rebuilt the file usage of %d owners.\n" % len(totals))
+
+    def add_field_totals(self, totals, model, field):
+        owner_field = field.quota_owner_field()
+        rows = model._default_manager.exclude(**{field.attname: ''}) \
+                                     .values_list(owner_field.attname, field.attname)
+        for owner_id, name in rows.iterator():
+            if owner_id is not None and name:
+                key = (owner_field.rel.to, owner_id)
+                totals[key] = totals.get(key, 0) + field.stored_size(name)
+
+    @transaction.commit_on_success
+    def save_totals(self, totals):
+        self.forget_cached_usage()
+        FileUsage.objects.all().delete()
+        # Uploads still holding one add their size when they are saved
+        QuotaReservation.objects.all().delete()
+        for (owner_model, owner_id), usage in totals.items():
+            FileUsage.objects.add_usage(owner_model, owner_id, usage)
+
+    def forget_cached_usage(self):
+        # Owners left without files get no add_usage call to invalidate them
+        if get_usage_cache() is not None:
+            for usage in FileUsage.objects.select_related('content_type').iterator():
+                owner_model = usage.content_type.model_class()
+                if owner_model is not None:
+                    FileUsage.objects.forget_usage(owner_model, usage.object_id)
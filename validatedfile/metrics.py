@@ -0,0 +1,110 @@
+import threading
+import time
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+class MetricsCollector(object):
+    """
+    Receives the instrumentation of the validation and quota hot paths. This
+    base collector discards everything; subclasses set enabled to True and
+    override the methods they need.
+
+    Phases timed: read, detect, size_check, quota_update. Counters:
+    bytes_read, storage_size_calls. Events: content_type (the detected type)
+    and rejected (content_type, extension, size or quota).
+    """
+    enabled = False
+
+    def timing(self, phase, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def event(self, name, value):
+        pass
+
+
+class RecordingCollector(MetricsCollector):
+    """
+    Collector that keeps everything in memory, for tests and benchmarks.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+
+    def timing(self, phase, seconds):
+        with self.lock:
+            self.timings.setdefault(phase, []).append(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def event(self, name, value):
+        with self.lock:
+            self.events.append((name, value))
+
+
+class Timer(object):
+
+    def __init__(self, collector, phase):
+        self.collector = collector
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.collector.timing(self.phase, time.time() - self.start)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+null_timer = NullTimer()
+
+_collector = None
+
+
+def get_collector():
+    """
+    Returns the collector set with set_collector, or else an instance of the
+    class named in the VALIDATEDFILE_METRICS_COLLECTOR setting.
+    """
+    global _collector
+    if _collector is None:
+        path = getattr(settings, 'VALIDATEDFILE_METRICS_COLLECTOR', None)
+        if path:
+            module_name, class_name = path.rsplit('.', 1)
+            _collector = getattr(import_module(module_name), class_name)()
+        else:
+            _collector = MetricsCollector()
+    return _collector
+
+
+def set_collector(collector):
+    global _collector
+    _collector = collector
+
+
+def timer(phase):
+    collector = get_collector()
+    if collector.enabled:
+        return Timer(collector, phase)
+    return null_timer
@@ -0,0 +1,151 @@
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from validatedfile.cache import get_usage_cache, usage_key
+
+# Cached in place of a total changed by a transaction that may not be
+# committed yet, for FORGOTTEN_TIMEOUT seconds
+FORGOTTEN = -1
+FORGOTTEN_TIMEOUT = 60
+
+
+class FileUsageManager(models.Manager):
+
+    def get_usage(self, owner_model, owner_id):
+        cache = get_usage_cache()
+        cached = None
+        if cache is not None:
+            cached = cache.get(usage_key(owner_model, owner_id))
+            if cached is not None and cached != FORGOTTEN:
+                return cached
+
+        content_type = ContentType.objects.get_for_model(owner_model)
+        usage = self.filter(content_type=content_type, object_id=owner_id).values_list('usage', flat=True)
+        usage = usage and usage[0] or 0
+        if cache is not None and cached is None:
+            # A marker written since the miss must win over the total read
+            cache.add(usage_key(owner_model, owner_id), usage)
+        return usage
+
+    def add_usage(self, owner_model, owner_id, delta):
+        if not delta:
+            return
+        content_type = ContentType.objects.get_for_model(owner_model)
+        usage = self.filter(content_type=content_type, object_id=owner_id)
+        if not usage.update(usage=F('usage') + delta) and delta > 0:
+            self.get_or_create(content_type=content_type, object_id=owner_id)
+            usage.update(usage=F('usage') + delta)
+
+        # A file of the owner was saved or deleted
+        self.forget_usage(owner_model, owner_id)
+
+    def forget_usage(self, owner_model, owner_id):
+        cache = get_usage_cache()
+        if cache is None:
+            return
+        if transaction.is_managed(using=self.db):
+            # Other connections read the old total until the transaction
+            # commits; had the entry been deleted, they would cache it again
+            cache.set(usage_key(owner_model, owner_id), FORGOTTEN, FORGOTTEN_TIMEOUT)
+        else:
+            cache.delete(usage_key(owner_model, owner_id))
+
+    def reserve(self, owner_model, owner_id, size, max_usage=-1, timeout=None):
+        """
+        Reserves size bytes for an upload of the owner if, added to its usage
+        and to the other reservations, they stay within max_usage (-1 for no
+        limit). The check and the increment are a single UPDATE, so parallel
+        uploads cannot overshoot the limit. Returns the QuotaReservation, or
+        None if there is no room for it.
+
+        Reservations not committed or released within timeout seconds
+        (VALIDATEDFILE_RESERVATION_TIMEOUT, one hour by default) are taken
+        as abandoned and released when their room is needed.
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'VALIDATEDFILE_RESERVATION_TIMEOUT', 3600)
+        content_type = ContentType.objects.get_for_model(owner_model)
+        self.get_or_create(content_type=content_type, object_id=owner_id)
+        if not self.reserve_size(content_type, owner_id, size, max_usage):
+            # Abandoned uploads may be holding the room
+            self.release_expired(owner_model, owner_id)
+            if not self.reserve_size(content_type, owner_id, size, max_usage):
+                return None
+        return QuotaReservation.objects.create(content_type=content_type, object_id=owner_id, size=size,
+                                               expires=timezone.now() + timedelta(seconds=timeout))
+
+    def reserve_size(self, content_type, owner_id, size, max_usage):
+        usage = self.filter(content_type=content_type, object_id=owner_id)
+        if max_usage >= 0:
+            usage = usage.filter(usage__lte=(max_usage - size) - F('reserved'))
+        return usage.update(reserved=F('reserved') + size)
+
+    def commit_reservation(self, reservation):
+        """
+        Moves the reserved size to the usage of the owner, once the file is
+        stored. Returns False if the reservation had already been released.
+        """
+        return self.end_reservation(reservation, reservation.size)
+
+    def release_reservation(self, reservation):
+        """
+        Gives the reserved size back, e.g. when the upload is not saved in
+        the end. Returns False if it had already been committed or released.
+        """
+        return self.end_reservation(reservation, 0)
+
+    def release_expired(self, owner_model=None, owner_id=None):
+        expired = QuotaReservation.objects.filter(expires__lte=timezone.now())
+        if owner_model is not None:
+            expired = expired.filter(content_type=ContentType.objects.get_for_model(owner_model),
+                                     object_id=owner_id)
+        for reservation in expired.iterator():
+            self.release_reservation(reservation)
+
+    def end_reservation(self, reservation, usage_delta):
+        # Only the first of commit, release or expiry gets the reservation.
+        # The token tells it from a later one given the same reused pk.
+        claimed = QuotaReservation.objects.filter(pk=reservation.pk, token=reservation.token,
+                                                  expires__isnull=False).update(expires=None)
+        if not claimed:
+            return False
+        self.filter(content_type=reservation.content_type_id, object_id=reservation.object_id) \
+            .update(usage=F('usage') + usage_delta, reserved=F('reserved') - reservation.size)
+        QuotaReservation.objects.filter(pk=reservation.pk, token=reservation.token).delete()
+        if usage_delta:
+            self.forget_usage(reservation.content_type.model_class(), reservation.object_id)
+        return True
+
+
+class FileUsage(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    usage = models.BigIntegerField(default=0)
+    reserved = models.BigIntegerField(default=0)
+
+    objects = FileUsageManager()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+
+def reservation_token():
+    return uuid4().hex
+
+
+class QuotaReservation(models.Model):
+    """
+    Room taken in the usage of an owner by an upload that is being validated
+    or saved. expires is cleared while the reservation is being ended.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    expires = models.DateTimeField(null=True, db_index=True)
+    token = models.CharField(max_length=32, unique=True, default=reservation_token)
@@ -0,0 +1,107 @@
+import mimetypes
+import os
+
+# Names some tools report instead of the registered type
+ALIASES = {
+    'image/jpg': 'image/jpeg',
+    'image/pjpeg': 'image/jpeg',
+    'image/x-png': 'image/png',
+    'image/x-ms-bmp': 'image/bmp',
+    'image/x-bmp': 'image/bmp',
+    'image/x-icon': 'image/vnd.microsoft.icon',
+    'application/x-pdf': 'application/pdf',
+    'application/x-zip-compressed': 'application/zip',
+    'text/xml': 'application/xml',
+}
+
+# Extensions missing from the mimetypes table of some platforms
+EXTENSIONS = {
+    'image/jpeg': ['.jpg', '.jpeg', '.jpe', '.jfif'],
+    'image/png': ['.png'],
+    'image/gif': ['.gif'],
+    'image/tiff': ['.tif', '.tiff'],
+    'image/webp': ['.webp'],
+    'application/pdf': ['.pdf'],
+    'application/zip': ['.zip'],
+    'application/msword': ['.doc', '.dot'],
+}
+
+
+def normalize_content_type(content_type):
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return ALIASES.get(content_type, content_type)
+
+
+_extensions = None
+
+
+def extensions_by_type():
+    # Built once per process, from the same table mimetypes.guess_type uses
+    global _extensions
+    if _extensions is None:
+        mimetypes.init()
+        extensions = {}
+        for extension, content_type in mimetypes.types_map.items():
+            extensions.setdefault(normalize_content_type(content_type), set()).add(extension)
+        for content_type, names in EXTENSIONS.items():
+            extensions.setdefault(content_type, set()).update(names)
+        _extensions = dict([(content_type, frozenset(names)) for content_type, names in extensions.items()])
+    return _extensions
+
+
+class ContentTypePolicy(object):
+    """
+    The content types allowed in a field, compiled once into frozen sets so
+    every upload is answered with a few hash lookups, whatever the number of
+    entries. Entries may be exact types, aliases of them ('image/jpg') or
+    wildcards of a whole family ('image/*', or '*/*' for anything).
+
+    With check_extension, the extension of the file name must also be one
+    of those registered for the detected type, when any is known.
+    """
+    __slots__ = ('exact_types', 'families', 'allow_all', 'check_extension')
+
+    def __init__(self, content_types=(), check_extension=False):
+        exact_types = set()
+        families = set()
+        allow_all = False
+        for content_type in content_types:
+            content_type = normalize_content_type(content_type)
+            if content_type in ('*', '*/*'):
+                allow_all = True
+            elif content_type.endswith('/*'):
+                families.add(content_type[:-2])
+            else:
+                exact_types.add(content_type)
+        self.exact_types = frozenset(exact_types)
+        self.families = frozenset(families)
+        self.allow_all = allow_all
+        self.check_extension = check_extension
+
+    def __contains__(self, content_type):
+        if not content_type:
+            return False
+        content_type = normalize_content_type(content_type)
+        return self.allow_all or content_type in self.exact_types or \
+            content_type.split('/', 1)[0] in self.families
+
+    def __nonzero__(self):
+        return bool(self.exact_types or self.families or self.allow_all)
+
+    __bool__ = __nonzero__
+
+    def listed_types(self):
+        """
+        Returns the exact types allowed, or None if wildcards allow others.
+        """
+        if self.families or self.allow_all:
+            return None
+        return self.exact_types
+
+    def extension_matches(self, name, content_type):
+        if not self.check_extension or not name:
+            return True
+        extensions = extensions_by_type().get(normalize_content_type(content_type))
+        if not extensions:
+            return True  # Nothing to compare with
+        return os.path.splitext(name)[1].lower() in extensions
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent by the model class when the deferred checks of a file have finished.
+# status is validatedfile.deferred.ACCEPTED or QUARANTINED, and errors the
+# messages of the failed checks.
+file_validated = Signal(providing_args=['pk', 'field_name', 'file_name', 'status', 'errors'])
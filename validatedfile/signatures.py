@@ -0,0 +1,61 @@
+# Magic numbers of the common types, for which libmagic always answers the
+# same mime type. Anything else (zip based documents, OLE files, text...)
+# needs the full libmagic database and is left undecided here.
+SIGNATURES = [
+    ('image/png', b'\x89PNG\r\n\x1a\n'),
+    ('image/jpeg', b'\xff\xd8\xff'),
+    ('image/gif', b'GIF87a'),
+    ('image/gif', b'GIF89a'),
+    ('image/tiff', b'II*\x00'),
+    ('image/tiff', b'MM\x00*'),
+    ('application/pdf', b'%PDF-'),
+]
+
+
+class SignatureTrie(object):
+
+    def __init__(self, signatures):
+        self.root = {}
+        self.max_length = 0
+        for content_type, signature in signatures:
+            node = self.root
+            for byte in bytearray(signature):
+                node = node.setdefault(byte, {})
+            node[None] = content_type
+            self.max_length = max(self.max_length, len(signature))
+
+    def match(self, buffer):
+        """
+        Returns the content type of the longest signature that prefixes the
+        buffer, or None if no signature matches or the buffer is too short to
+        tell.
+        """
+        node = self.root
+        content_type = None
+        for byte in bytearray(buffer[:self.max_length]):
+            node = node.get(byte)
+            if node is None:
+                return content_type
+            content_type = node.get(None, content_type)
+        if len(node) > (None in node):
+            return None  # A longer signature could still match
+        return content_type
+
+
+signature_trie = SignatureTrie(SIGNATURES)
+
+
+def match_signature(buffer):
+    return signature_trie.match(buffer)
+
+
+def sniff_length(content_types, default):
+    """
+    Returns how many bytes must be read to decide between the given content
+    types, or the default when any of them needs libmagic or they are not
+    listed (None).
+    """
+    known_types = set(content_type for content_type, signature in SIGNATURES)
+    if content_types and set(content_types) <= known_types:
+        return min(signature_trie.max_length, default)
+    return default
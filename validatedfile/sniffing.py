@@ -0,0 +1,85 @@
+import mmap
+import os
+import threading
+
+_buffers = threading.local()
+
+
+def reusable_buffer(length):
+    """
+    Returns a bytearray of the given length owned by the current thread, so
+    sniffing in-memory uploads reads into the same buffer each time. The
+    bytes handed back are still a copy of it, as with file.read(length).
+    """
+    buffers = getattr(_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = _buffers.buffers = {}
+    buffer = buffers.get(length)
+    if buffer is None:
+        buffer = buffers[length] = bytearray(length)
+    return buffer
+
+
+def peek(file, length):
+    """
+    Returns up to length bytes from the start of the file, leaving the file
+    object at the position it was. The bytes are copied once from the mapped
+    or read data. Files that cannot seek raise IOError instead of losing the
+    bytes read, which would then be missing when the file is saved.
+    """
+    temporary_file_path = getattr(file, 'temporary_file_path', None)
+    if temporary_file_path is not None:
+        return peek_path(temporary_file_path(), length)
+    return peek_stream(file, length)
+
+
+class PeekedPrefix(object):
+    """
+    The leading bytes of a file, peeked once for all the checks that need
+    them. The first read takes at least min_length bytes, the most any of
+    them is known to need; a longer read is only made when one asks for more.
+    """
+
+    def __init__(self, file, min_length=0):
+        self.file = file
+        self.min_length = min_length
+        self.buffer = None
+        self.read_length = 0
+
+    def read(self, length):
+        if self.buffer is None or len(self.buffer) == self.read_length < length:
+            self.read_length = max(length, self.min_length)
+            self.buffer = peek(self.file, self.read_length)
+        return self.buffer[:length]
+
+
+def peek_path(path, length):
+    # Map the spooled upload instead of reading through the caller's file
+    # object, which is left untouched.
+    with open(path, 'rb') as file:
+        length = min(length, os.fstat(file.fileno()).st_size)
+        if not length:
+            return b''
+        view = mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ)
+        try:
+            return view[:length]
+        finally:
+            view.close()
+
+
+def peek_stream(file, length):
+    try:
+        position = file.tell()
+    except (AttributeError, IOError):
+        raise IOError("Cannot peek at %r without consuming it, as it does not seek" % file)
+
+    file.seek(0)
+    try:
+        readinto = getattr(file, 'readinto', None)
+        if readinto is None:
+            return file.read(length)
+        buffer = reusable_buffer(length)
+        # Slicing the bytearray would copy it once more
+        return memoryview(buffer)[:readinto(buffer)].tobytes()
+    finally:
+        file.seek(position)
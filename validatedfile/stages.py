@@ -0,0 +1,459 @@
+import copy
+import hashlib
+import socket
+import struct
+import zipfile
+import zlib
+
+from django import forms
+from django.template.defaultfilters import filesizeformat
+from django.utils.translation import ugettext as _
+
+from validatedfile.images import INCOMPLETE, image_dimensions
+from validatedfile.policies import ContentTypePolicy
+from validatedfile.sniffing import PeekedPrefix
+
+
+class ValidationStage(object):
+    """
+    One check of a ValidationPipeline. A copy of the stage is made for every
+    file, so it can keep its state in attributes.
+
+    start() is called first; it and feed() return True while the stage wants
+    more chunks of the file, which only stages that reads() the file may do.
+    finish() is called once no stage wants more, and close() always at the
+    end, even if another stage failed. Any of them may raise
+    forms.ValidationError; if the stage is hard the pipeline stops at once,
+    otherwise the error is reported after the other stages ran.
+
+    Stages that only look at the leading bytes read them with peek(), which
+    the stages of a run share; peek_length() tells how many they need.
+    """
+    hard = True
+    needs_stream = False
+    peeked = None
+
+    def reads(self, file):
+        return self.needs_stream
+
+    def peek_length(self, field):
+        return 0
+
+    def peek(self, length):
+        if self.peeked is None:
+            self.peeked = PeekedPrefix(self.file)
+        return self.peeked.read(length)
+
+    def start(self, field, file, streaming):
+        self.field = field
+        self.file = file
+        return self.reads(file)
+
+    def feed(self, chunk):
+        return True
+
+    def finish(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ContentTypeStage(ValidationStage):
+    checked = False
+
+    def peek_length(self, field):
+        return field.sniff_length
+
+    def start(self, field, file, streaming):
+        super(ContentTypeStage, self).start(field, file, streaming)
+        if not streaming:
+            # Nobody reads the whole file, so peek just the bytes needed
+            self.checked = True
+            field.check_content_type(field.sniff_content_type(file, peeked=self.peeked), getattr(file, 'name', None))
+            return False
+        self.prefix = b''
+        self.checked = False
+        return True
+
+    def feed(self, chunk):
+        self.prefix += chunk[:self.field.mime_lookup_length - len(self.prefix)]
+        if len(self.prefix) < self.field.mime_lookup_length:
+            return True
+        self.check()
+        return False
+
+    def finish(self):
+        if not self.checked:
+            self.check()
+
+    def check(self):
+        self.checked = True
+        self.field.check_content_type(self.field.sniff_content_type(self.file, self.prefix),
+                                      getattr(self.file, 'name', None))
+
+
+class MaxSizeStage(ValidationStage):
+    """
+    Rejects an oversize file as soon as the content type stage has decided,
+    so a file both too big and of the wrong type gets the type error: at
+    once if the type is not checked or was checked in start(), otherwise
+    when the bytes it sniffs have been fed, before the rest of the file.
+    """
+    known_size = None
+    pending = False
+
+    def start(self, field, file, streaming):
+        super(MaxSizeStage, self).start(field, file, streaming)
+        self.known_size = hasattr(file, '_size') and file._size or None
+        self.read = 0
+        self.type_decided = not (streaming and field.content_types)
+        if self.known_size is not None and self.type_decided:
+            field.check_size(self.known_size)
+            return False
+        self.pending = streaming
+        return streaming
+
+    def feed(self, chunk):
+        self.read += len(chunk)
+        if self.read >= self.field.mime_lookup_length:
+            self.type_decided = True
+        if not self.type_decided:
+            return True
+        if self.known_size is None:
+            self.field.check_size(self.read)
+            return True
+        self.pending = False
+        self.field.check_size(self.known_size)
+        return False
+
+    def finish(self):
+        if self.pending and self.known_size is None:
+            self.field.check_size(self.read)
+        elif self.pending:
+            self.field.check_size(self.known_size)
+
+
+class ImageDimensionsStage(ValidationStage):
+    """
+    Checks the width, height and pixel count of PNG, GIF, WebP and JPEG
+    images from their headers, without decoding them. JPEG dimensions may
+    come after the sniffed bytes, so up to header_length bytes are read.
+    """
+
+    def __init__(self, max_dimensions=None, max_pixels=None, header_length=65536):
+        self.max_dimensions = max_dimensions
+        self.max_pixels = max_pixels
+        self.header_length = header_length
+
+    def peek_length(self, field):
+        return field.mime_lookup_length
+
+    def start(self, field, file, streaming):
+        super(ImageDimensionsStage, self).start(field, file, streaming)
+        if not streaming:
+            buffer = self.peek(field.mime_lookup_length)
+            dimensions = image_dimensions(buffer)
+            if dimensions == INCOMPLETE and len(buffer) == field.mime_lookup_length:
+                buffer = self.peek(self.header_length)
+                dimensions = image_dimensions(buffer)
+            self.check(dimensions)
+            return False
+        self.buffer = b''
+        self.checked = False
+        return True
+
+    def feed(self, chunk):
+        self.buffer += chunk[:self.header_length - len(self.buffer)]
+        dimensions = image_dimensions(self.buffer)
+        if dimensions == INCOMPLETE and len(self.buffer) < self.header_length:
+            return True
+        self.check(dimensions)
+        return False
+
+    def finish(self):
+        if not self.checked:
+            self.check(image_dimensions(self.buffer))
+
+    def check(self, dimensions):
+        self.checked = True
+        if dimensions is None:
+            return  # Not an image, or not a format with known headers
+        if dimensions == INCOMPLETE:
+            raise forms.ValidationError(_('The dimensions of the image could not be read.'))
+
+        width, height = dimensions
+        if self.max_dimensions:
+            max_width, max_height = self.max_dimensions
+            if width > max_width or height > max_height:
+                raise forms.ValidationError(
+                    _('Images larger than %(max_width)sx%(max_height)s pixels are not allowed. Your image is %(width)sx%(height)s') %
+                    {'max_width': max_width, 'max_height': max_height, 'width': width, 'height': height}
+                )
+        if self.max_pixels and width * height > self.max_pixels:
+            raise forms.ValidationError(
+                _('Images of more than %(max_pixels)s pixels are not allowed. Your image has %(pixels)s') %
+                {'max_pixels': self.max_pixels, 'pixels': width * height}
+            )
+
+
+class ArchiveStage(ValidationStage):
+    """
+    Inspects zip archives without extracting them. The member count, the
+    uncompressed sizes and the compression ratios are checked from the
+    central directory, and only the first bytes of each member are
+    decompressed to sniff its type. Files that are not zip archives pass.
+
+    The sizes are those declared in the archive; code that extracts it later
+    should still stop at them.
+    """
+
+    def __init__(self, member_types=None, max_members=None, max_size=None, max_ratio=None):
+        self.member_types = member_types
+        self.member_policy = ContentTypePolicy(member_types or [])
+        self.max_members = max_members
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+
+    def start(self, field, file, streaming):
+        super(ArchiveStage, self).start(field, file, streaming)
+        if self.peek(4) not in (b'PK\x03\x04', b'PK\x05\x06'):
+            return False
+
+        position = file.tell()
+        try:
+            archive = zipfile.ZipFile(file)
+            try:
+                self.check_archive(archive)
+            finally:
+                archive.close()
+        except zipfile.BadZipfile:
+            raise forms.ValidationError(_('The archive is corrupt.'))
+        finally:
+            file.seek(position)
+        return False
+
+    def check_archive(self, archive):
+        members = [info for info in archive.infolist() if not info.filename.endswith('/')]
+        if self.max_members and len(members) > self.max_members:
+            raise forms.ValidationError(
+                _('Archives with more than %(max_members)s files are not allowed.') %
+                {'max_members': self.max_members}
+            )
+
+        total_size = sum([info.file_size for info in members])
+        if self.max_size and total_size > self.max_size:
+            raise forms.ValidationError(
+                _('Archives with more than %(max_size)s of uncompressed content are not allowed.') %
+                {'max_size': filesizeformat(self.max_size)}
+            )
+
+        for info in members:
+            if self.max_ratio and info.file_size > self.max_ratio * max(info.compress_size, 1):
+                raise forms.ValidationError(
+                    _('Archive files compressed more than %(max_ratio)s times are not allowed.') %
+                    {'max_ratio': self.max_ratio}
+                )
+            if self.member_types:
+                self.check_member_type(archive, info)
+
+    def check_member_type(self, archive, info):
+        try:
+            member = archive.open(info)
+            try:
+                prefix = member.read(self.field.mime_lookup_length)
+            finally:
+                member.close()
+        except (RuntimeError, NotImplementedError, zipfile.BadZipfile, zlib.error):
+            raise forms.ValidationError(
+                _('The archive file %(name)s could not be read.') % {'name': info.filename}
+            )
+
+        content_type = self.field.detect_content_type(prefix)
+        if not content_type in self.member_policy:
+            raise forms.ValidationError(
+                _('Archive files of type %(type)s are not supported.') % {'type': content_type}
+            )
+
+
+class PdfStructureStage(ValidationStage):
+    """
+    Reads the whole of a PDF file to check its header, its trailer and that
+    the cross-reference offset points inside the file. Too slow for large
+    files to run in the request; meant for deferred validation.
+    """
+    needs_stream = True
+    tail_length = 1024
+
+    def start(self, field, file, streaming):
+        super(PdfStructureStage, self).start(field, file, streaming)
+        self.head = b''
+        self.tail = b''
+        self.size = 0
+        return True
+
+    def feed(self, chunk):
+        if len(self.head) < 5:
+            self.head += chunk[:5 - len(self.head)]
+        self.tail = (self.tail + chunk)[-self.tail_length:]
+        self.size += len(chunk)
+        return True
+
+    def finish(self):
+        if self.head != b'%PDF-':
+            return  # Not a PDF
+        trailer = self.tail.rstrip()
+        if not trailer.endswith(b'%%EOF') or b'startxref' not in trailer:
+            self.damaged()
+        try:
+            offset = int(trailer.rsplit(b'startxref', 1)[1][:-len(b'%%EOF')].strip())
+        except ValueError:
+            self.damaged()
+        if offset >= self.size:
+            self.damaged()
+
+    def damaged(self):
+        raise forms.ValidationError(_('The PDF file is damaged.'))
+
+
+class DigestStage(ValidationStage):
+    needs_stream = True
+    digest = None
+
+    def reads(self, file):
+        # Stored files whose digest is already known are not read again
+        return getattr(file, 'content_digest', None) is None
+
+    def start(self, field, file, streaming):
+        if not super(DigestStage, self).start(field, file, streaming):
+            return False
+        self.digest = hashlib.new(field.digest_algorithm)
+        return True
+
+    def feed(self, chunk):
+        self.digest.update(chunk)
+        return True
+
+    def finish(self):
+        if self.digest is not None:
+            self.file.content_digest = self.digest.hexdigest()
+
+
+class SocketScannerStage(ValidationStage):
+    """
+    Streams the file to a content scanner speaking the clamd INSTREAM
+    protocol, listening on a (host, port) address or a unix socket path.
+    """
+    needs_stream = True
+
+    def __init__(self, address, timeout=30, hard=True):
+        self.address = address
+        self.timeout = timeout
+        self.hard = hard
+
+    def start(self, field, file, streaming):
+        super(SocketScannerStage, self).start(field, file, streaming)
+        family = isinstance(self.address, tuple) and socket.AF_INET or socket.AF_UNIX
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        try:
+            self.socket.connect(self.address)
+            self.socket.sendall(b'zINSTREAM\0')
+        except socket.error:
+            self.scan_failed()
+        return True
+
+    def feed(self, chunk):
+        try:
+            self.socket.sendall(struct.pack('!L', len(chunk)) + chunk)
+        except socket.error:
+            self.scan_failed()
+        return True
+
+    def finish(self):
+        try:
+            self.socket.sendall(struct.pack('!L', 0))
+            reply = b''
+            while not reply.endswith(b'\0'):
+                data = self.socket.recv(4096)
+                if not data:
+                    break
+                reply += data
+        except socket.error:
+            self.scan_failed()
+
+        reply = reply.rstrip(b'\0').decode('utf-8', 'replace')
+        if reply.endswith(' FOUND'):
+            name = reply[:-len(' FOUND')].split(': ', 1)[-1]
+            raise forms.ValidationError(
+                _('The file did not pass the content scan (%(result)s).') % {'result': name}
+            )
+        if not reply.endswith(' OK'):
+            self.scan_failed()
+
+    def close(self):
+        self.socket.close()
+
+    def scan_failed(self):
+        raise forms.ValidationError(_('The file could not be scanned.'))
+
+
+class ValidationPipeline(object):
+    """
+    Runs the stages of a field over a file, reading it at most once: every
+    stage is fed the same chunks, and reading stops as soon as no stage
+    wants more.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def run(self, field, file):
+        stages = [copy.copy(stage) for stage in self.stages]
+        streaming = any([stage.reads(file) for stage in stages])
+        # Read on first use, as much as the stages that peek need at most
+        peeked = PeekedPrefix(file, max([stage.peek_length(field) for stage in stages] + [0]))
+        for stage in stages:
+            stage.peeked = peeked
+        errors = []
+        started = []
+        try:
+            active = []
+            for stage in stages:
+                started.append(stage)
+                if self.call(stage, errors, stage.start, field, file, streaming):
+                    active.append(stage)
+
+            if active:
+                position = file.tell()
+                try:
+                    for chunk in file.chunks():
+                        active = [stage for stage in active
+                                  if self.call(stage, errors, stage.feed, chunk)]
+                        if not active:
+                            break
+                finally:
+                    file.seek(position)
+
+            failed = [stage for stage, error in errors]
+            for stage in stages:
+                if stage not in failed:
+                    self.call(stage, errors, stage.finish)
+        finally:
+            for stage in started:
+                stage.close()
+
+        if errors:
+            raise forms.ValidationError([message for stage, error in errors
+                                         for message in error.messages])
+
+    def call(self, stage, errors, method, *args):
+        if stage in [failed for failed, error in errors]:
+            return False
+        try:
+            return method(*args)
+        except forms.ValidationError as e:
+            if stage.hard:
+                raise
+            errors.append((stage, e))
+            return False
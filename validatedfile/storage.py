@@ -0,0 +1,129 @@
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from validatedfile import metrics
+
+
+class DeduplicatingStorageMixin(object):
+    """
+    Stores every file under a name derived from the digest of its content,
+    and reuses the existing blob instead of writing a new copy when the same
+    content is saved again. The digest left by ValidatedFileField in the
+    content_digest attribute of the file is used when present.
+
+    Blobs may be shared by several rows, so delete() does not remove them.
+    """
+    digest_algorithm = 'sha256'
+
+    def save(self, name, content, *args, **kwargs):
+        if name is None:
+            name = content.name
+        name = self.digest_name(name, self.content_digest(content))
+        if self.exists(name):
+            return name
+        return super(DeduplicatingStorageMixin, self).save(name, content, *args, **kwargs)
+
+    def delete(self, name):
+        pass
+
+    def content_digest(self, content):
+        digest = getattr(content, 'content_digest', None)
+        if digest is None:
+            hasher = hashlib.new(self.digest_algorithm)
+            for chunk in content.chunks():
+                hasher.update(chunk)
+            digest = hasher.hexdigest()
+        return digest
+
+    def digest_name(self, name, digest):
+        dir_name, file_name = os.path.split(name)
+        file_root, file_ext = os.path.splitext(file_name)
+        return os.path.join(dir_name, digest[:2], digest + file_ext)
+
+
+class DeduplicatingFileSystemStorage(DeduplicatingStorageMixin, FileSystemStorage):
+    pass
+
+
+class StoredFile(File):
+    """
+    Read only file object over a file already in a storage, for checking it
+    without fetching all of it. Reads are asked to the storage as byte ranges
+    when it has a read_range(name, start, length) method; otherwise the file
+    is opened on the first read and read from there. The size is taken from
+    the storage metadata.
+    """
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.mode = 'rb'
+        self.file = None
+        self.position = 0
+        self._stored_size = None
+
+    def _get_size(self):
+        if self._stored_size is None:
+            metrics.get_collector().count('storage_size_calls')
+            self._stored_size = self.storage.size(self.name)
+        return self._stored_size
+
+    size = property(_get_size)
+    _size = property(_get_size)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size - self.position, 0)
+        read_range = getattr(self.storage, 'read_range', None)
+        if read_range is not None:
+            data = read_range(self.name, self.position, size)
+        else:
+            if self.file is None:
+                self.file = self.storage.open(self.name, 'rb')
+            self.file.seek(self.position)
+            data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        self.seek(0)
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def multiple_chunks(self, chunk_size=None):
+        return self.size > (chunk_size or self.DEFAULT_CHUNK_SIZE)
+
+    def open(self, mode=None):
+        self.seek(0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @property
+    def closed(self):
+        return False
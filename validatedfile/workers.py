@@ -0,0 +1,60 @@
+from multiprocessing.pool import ThreadPool
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger('validatedfile')
+
+
+class ThreadPools(object):
+    """
+    Keeps one long lived pool of threads per size, so the detectors of its
+    workers are created once and reused by every batch.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def get(self, size):
+        if self._pid != os.getpid():
+            self.reset()
+        with self._lock:
+            pool = self._pools.get(size)
+            if pool is None:
+                pool = self._pools[size] = ThreadPool(size)
+            return pool
+
+    def reset(self):
+        self._pools = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+
+thread_pools = ThreadPools()
+
+
+def logged_callback(callback):
+    """
+    Wraps a callback for apply_async so an exception it raises is logged. On
+    Python 2 it would otherwise kill the thread of the pool that hands out
+    the results, and every later task of the pool would wait forever.
+    """
+    if callback is None:
+        return None
+
+    def call(result):
+        try:
+            callback(result)
+        except Exception:
+            logger.exception("Callback %r of a background task failed", callback)
+    return call
+
+
+def background_pool():
+    """
+    Bounded pool where the blocking work of the *_async methods is run,
+    sized by the VALIDATEDFILE_ASYNC_WORKERS setting.
+    """
+    return thread_pools.get(getattr(settings, 'VALIDATEDFILE_ASYNC_WORKERS', 4))